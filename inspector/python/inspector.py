@@ -1,11 +1,21 @@
 
 import json
-import httplib
-import base64,zlib
-import urlparse
+import http.client
+import zlib
+import queue
+import time
+import threading
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 import boto3
 import datetime
 import logging
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 ##################################################################
 # Configuration                                                  #
@@ -14,37 +24,140 @@ import logging
 sumoEndpoint = "https://endpoint1.collection.sumologic.com/receiver/v1/http/<XXXX>"
 # include auxiliary data (e.g for assessment template, run, or target) in the collected event or not
 contextLookup = True
+# records are sent to Sumo in newline delimited batches of at most this many bytes(before compression)
+maxPayloadSize = 1024 * 1024
+# payloads smaller than compressThreshold bytes are sent uncompressed, payloads up to largePayloadSize bytes are
+# compressed with fastCompressLevel and larger ones with largeCompressLevel
+compressThreshold = 1024
+largePayloadSize = 256 * 1024
+fastCompressLevel = 1
+largeCompressLevel = 6
+# compress with zstd instead of gzip, enable only if the receiving endpoint accepts zstd(requires zstandard package)
+useZstd = False
+# looked up objects are cached for lookupCacheTTL seconds, at most lookupCacheSize objects are kept
+lookupCacheSize = 1000
+lookupCacheTTL = 3600
+# number of describe calls and records enriched concurrently
+maxLookupWorkers = 8
+# looked up objects of persistentLookupTypes are also kept in a second level cache which survives container restarts,
+# persistentCacheFile is a file cache for the container and persistentCacheTable is a DynamoDB table(with a string
+# partition key named "key") shared by all the containers, set either of them to None to disable it
+persistentLookupTypes = ('template', 'target', 'rulesPackage')
+persistentCacheTTL = 24 * 3600
+persistentCacheFile = '/tmp/inspector_lookup_cache.json'
+persistentCacheTable = None
 
 
 ##################################################################
 # Main Code                                                      #
 ##################################################################
-up = urlparse.urlparse(sumoEndpoint)
+up = urlparse(sumoEndpoint)
 options = { 'hostname': up.hostname,
                 'path': up.path,
                 'method': 'POST'
             };
 
-# Internal variables used for this Lambda function
-resourceMap = {'finding':{},'target':{},'run':{},'template':{}, 'rulesPackage':{}}
 # prepare logger
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# main function to send data to a Sumo HTTP source
+class SumoConnectionPool(object):
+    """Keeps HTTPS connections to the Sumo endpoint open across records and warm invocations."""
+
+    def __init__(self, hostname, maxsize=4, timeout=30):
+        self.hostname = hostname
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.connections = queue.LifoQueue()
+        self.stats = {'requests': 0, 'reconnects': 0, 'totalLatency': 0.0}
+
+    def _newConnection(self):
+        return http.client.HTTPSConnection(self.hostname, timeout=self.timeout)
+
+    def _getConnection(self):
+        try:
+            return self.connections.get_nowait()
+        except queue.Empty:
+            return self._newConnection()
+
+    def _releaseConnection(self, conn):
+        if self.connections.qsize() < self.maxsize:
+            self.connections.put_nowait(conn)
+        else:
+            conn.close()
+
+    def request(self, method, path, body, headers):
+        conn = self._getConnection()
+        start = time.time()
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+        except (ConnectionError, http.client.HTTPException) as e:
+            # pooled connection was closed by the server, retrying once on a new connection
+            logger.info("Reconnecting to %s after error: %s" % (self.hostname, e))
+            conn.close()
+            self.stats['reconnects'] += 1
+            conn = self._newConnection()
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+            except Exception:
+                conn.close()
+                raise
+        # response has to be read completely before the connection can be reused
+        try:
+            response.read()
+        except Exception:
+            conn.close()
+            raise
+        latency = time.time() - start
+        self.stats['requests'] += 1
+        self.stats['totalLatency'] += latency
+        if response.will_close:
+            conn.close()
+        else:
+            self._releaseConnection(conn)
+        return response.status, response.reason, latency
+
+
+connectionPool = SumoConnectionPool(options['hostname'])
+
+
+# chooses the encoding for a payload based on its size, returns the payload to send and its Content-Encoding
+def compressPayload(data):
+    if (len(data) < compressThreshold):
+        return data, None
+    start = time.thread_time()
+    if (useZstd and zstandard is not None):
+        encoding, level = 'zstd', 3
+        finalData = zstandard.ZstdCompressor(level=level).compress(data)
+    else:
+        encoding = 'gzip'
+        level = fastCompressLevel if len(data) <= largePayloadSize else largeCompressLevel
+        finalData = compress(data, level)
+    cpuTime = time.thread_time() - start
+    logger.info("Compressed %d bytes to %d bytes encoding: %s level: %d ratio: %.2f cpuTime: %.3f ms" % (
+        len(data), len(finalData), encoding, level, float(len(data)) / max(len(finalData), 1), cpuTime * 1000))
+    return finalData, encoding
+
+
+# main function to send data to a Sumo HTTP source, returns status, reason and latency in seconds
 def sendSumo(msg, toCompress = False):
-    conn = httplib.HTTPSConnection(options['hostname'])
+    if isinstance(msg, str):
+        msg = msg.encode('utf-8')
+    encoding = None
     if (toCompress):
-        headers = {"Content-Encoding": "gzip"}
-        finalData = compress(msg)
+        finalData, encoding = compressPayload(msg)
+    else:
+        finalData = msg
+    if (encoding):
+        headers = {"Content-Encoding": encoding}
     else:
         headers = {"Content-type": "text/html","Accept": "text/plain"}
-        finalData =msg
     headers.update({"X-Sumo-Client": "inspector-aws-lambda"})
-    conn.request(options['method'], options['path'], finalData,headers)
-    response = conn.getresponse()
-    conn.close()
-    return (response.status,response.reason)
+    status, reason, latency = connectionPool.request(options['method'], options['path'], finalData, headers)
+    logger.info("Sent %d bytes to Sumo in %.3f seconds" % (len(finalData), latency))
+    return (status, reason, latency)
 
 
 # Simple function to compress data
@@ -54,123 +167,389 @@ def compress(data, compresslevel=9):
     compressedData += compress.flush()
     return compressedData
 
-# This function looks up an Inspector object based on its arn and type. Returned object will be used to provide extra context for the final message to Sumo
-def lookup(objectId,objectType = 'run'):
-    client = boto3.client('inspector')
-    finalObj = None
+class LRUCache(object):
+    """Least recently used cache with a maximum size whose entries expire after ttl seconds."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if (entry is None):
+                return None
+            if (entry[1] < time.time()):
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.time() + self.ttl)
+            self.entries.move_to_end(key)
+            while (len(self.entries) > self.maxsize):
+                self.entries.popitem(last=False)
+
+
+class MemoryCache(object):
+    """Second level cache kept in a dict, used as a stand-in for the other caches in tests."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def getMany(self, keys):
+        now = time.time()
+        with self.lock:
+            return {key: self.items[key][0] for key in keys if key in self.items and self.items[key][1] > now}
 
-    objectMap = resourceMap.get(objectType)
-    if (objectMap is None):
-        resourceMap[objectType]= objectMap = {}
+    def putMany(self, items):
+        with self.lock:
+            for key, value in items.items():
+                self.items[key] = (value, time.time() + self.ttl)
+
+
+class FileCache(MemoryCache):
+    """Second level cache saved as a json file, on lambda the file is kept in /tmp."""
+
+    def __init__(self, path, ttl):
+        super(FileCache, self).__init__(ttl)
+        self.path = path
+        if (os.path.isfile(path)):
+            try:
+                with open(path) as f:
+                    self.items = {key: tuple(entry) for key, entry in json.load(f).items()}
+            except (IOError, ValueError) as e:
+                logger.error("Could not load lookup cache %s: %s" % (path, e))
+
+    def putMany(self, items):
+        super(FileCache, self).putMany(items)
+        now = time.time()
+        with self.lock:
+            self.items = {key: entry for key, entry in self.items.items() if entry[1] > now}
+            tmpPath = self.path + '.tmp'
+            with open(tmpPath, 'w') as f:
+                json.dump(self.items, f, default=json_deserializer)
+            os.rename(tmpPath, self.path)
+
+
+class DynamoDBCache(object):
+    """Second level cache shared by all the containers, endpointUrl can point to a local DynamoDB for tests."""
+
+    def __init__(self, tableName, ttl, endpointUrl=None):
+        self.tableName = tableName
+        self.ttl = ttl
+        self.client = boto3.client('dynamodb', endpoint_url=endpointUrl)
+
+    def getMany(self, keys):
+        items, now = {}, time.time()
+        keys = list(keys)
+        # BatchGetItem accepts at most 100 keys
+        for i in range(0, len(keys), 100):
+            request = {self.tableName: {'Keys': [{'key': {'S': key}} for key in keys[i:i + 100]]}}
+            while request:
+                response = self.client.batch_get_item(RequestItems=request)
+                for item in response['Responses'].get(self.tableName, []):
+                    if (float(item['expiresAt']['N']) > now):
+                        items[item['key']['S']] = json.loads(item['value']['S'])
+                request = response.get('UnprocessedKeys')
+        return items
+
+    def putMany(self, items):
+        expiresAt = str(int(time.time() + self.ttl))
+        requests = [{'PutRequest': {'Item': {'key': {'S': key}, 'value': {'S': json.dumps(value, default=json_deserializer)},
+                                             'expiresAt': {'N': expiresAt}}}} for key, value in items.items()]
+        # BatchWriteItem accepts at most 25 items
+        for i in range(0, len(requests), 25):
+            request = {self.tableName: requests[i:i + 25]}
+            while request:
+                request = self.client.batch_write_item(RequestItems=request).get('UnprocessedItems')
+
+
+def getPersistentCaches():
+    caches = []
+    if (persistentCacheFile):
+        caches.append(FileCache(persistentCacheFile, persistentCacheTTL))
+    if (persistentCacheTable):
+        caches.append(DynamoDBCache(persistentCacheTable, persistentCacheTTL))
+    return caches
+
+
+# objectType -> (describe api, arns parameter, response key), every describe api accepts at most 10 arns
+lookupApis = {
+    'run': ('describe_assessment_runs', 'assessmentRunArns', 'assessmentRuns'),
+    'template': ('describe_assessment_templates', 'assessmentTemplateArns', 'assessmentTemplates'),
+    'target': ('describe_assessment_targets', 'assessmentTargetArns', 'assessmentTargets'),
+    'rulesPackage': ('describe_rules_packages', 'rulesPackageArns', 'rulesPackages'),
+    'finding': ('describe_findings', 'findingArns', 'findings')
+}
+maxArnsPerCall = 10
+lookupCache = LRUCache(lookupCacheSize, lookupCacheTTL)
+lookupStats = {'hits': 0, 'persistentHits': 0, 'misses': 0, 'apiCalls': 0}
+lookupStatsLock = threading.Lock()
+inspectorClient = None
+persistentCaches = None
+
+
+def getInspectorClient():
+    global inspectorClient
+    if (inspectorClient is None):
+        inspectorClient = boto3.client('inspector')
+    return inspectorClient
+
+
+# calls the describe api of objectType once for the given arns, caches and returns the objects by their arn
+def describe(objectType, arns):
+    apiName, paramName, responseKey = lookupApis[objectType]
     try:
-        if (objectType=='run'):
-            run = objectMap.get(objectId)
-            if (run is None):
-                runs = client.describe_assessment_runs(assessmentRunArns=[objectId])
-                if (runs is not None):
-                    run = runs['assessmentRuns'][0]
-                    # For run item, we only collect important properties
-                    objectMap[objectId] = finalObj = {'name':run['name'],'createdAt':'%s' % run['createdAt'], 'state':run['state'],'durationInSeconds':run['durationInSeconds'],'startedAt':'%s' % run['startedAt'],'assessmentTemplateArn':run['assessmentTemplateArn']}
-            else:
-                finalObj = run
-        elif (objectType=='template'):
-            template = objectMap.get(objectId)
-            if (template is None):
-                templates = client.describe_assessment_templates(assessmentTemplateArns=[objectId])
-                if (templates is not None):
-                    finalObj = objectMap[objectId] =  templates['assessmentTemplates'][0]
-            else:
-                finalObj = template
-        elif (objectType=='rulesPackage'):
-            rulesPackage = objectMap.get(objectId)
-            if (rulesPackage is None):
-                rulesPackages = client.describe_rules_packages(rulesPackageArns=[objectId])
-                if (rulesPackages is not None):
-                    finalObj = objectMap[objectId] =  rulesPackages['rulesPackages'][0]
-            else:
-                finalObj = rulesPackage
-        elif (objectType=='target'):
-            target = objectMap.get(objectId)
-            if (target is None):
-                targets = client.describe_assessment_targets(assessmentTargetArns=[objectId])
-                if (targets is not None):
-                    finalObj = objectMap[objectId] = targets['assessmentTargets'][0]
-            else:
-                finalObj = target
-        elif (objectType == 'finding'):
-            finding = objectMap.get(objectId)
-            if (finding is None):
-                findings = client.describe_findings(findingArns=[objectId])
-                if (findings is not None):
-                    finalObj = objectMap[objectId] = findings['findings'][0]
-            else:
-                finalObj = finding
+        response = getattr(getInspectorClient(), apiName)(**{paramName: arns})
     except Exception as e:
         logger.error(e)
         raise
+    with lookupStatsLock:
+        lookupStats['apiCalls'] += 1
+    items = {}
+    for item in response[responseKey]:
+        arn = item['arn']
+        if (objectType == 'run'):
+            # For run item, we only collect important properties
+            item = {'name':item['name'],'createdAt':'%s' % item['createdAt'], 'state':item['state'],'durationInSeconds':item['durationInSeconds'],'startedAt':'%s' % item['startedAt'],'assessmentTemplateArn':item['assessmentTemplateArn']}
+        lookupCache.put((objectType, arn), item)
+        items[arn] = item
+    return objectType, items
+
+
+# looks up the given arns in the second level caches, found objects are cached in memory and returns the missing arns
+def loadPersistent(objectType, arns):
+    if (objectType not in persistentLookupTypes or not arns):
+        return arns
+    keys = OrderedDict(("%s|%s" % (objectType, arn), arn) for arn in arns)
+    missingKeys = list(keys)
+    for idx, cache in enumerate(persistentCaches):
+        try:
+            found = cache.getMany(missingKeys)
+        except Exception as e:
+            logger.error("Could not read lookup cache %s: %s" % (type(cache).__name__, e))
+            continue
+        for key, value in found.items():
+            lookupCache.put((objectType, keys[key]), value)
+        if (found):
+            # objects found in a shared cache are copied to the caches before it
+            for previousCache in persistentCaches[:idx]:
+                storeQuietly(previousCache, found)
+        missingKeys = [key for key in missingKeys if key not in found]
+    with lookupStatsLock:
+        lookupStats['persistentHits'] += len(arns) - len(missingKeys)
+    return [keys[key] for key in missingKeys]
+
+
+def storeQuietly(cache, items):
+    try:
+        cache.putMany(items)
+    except Exception as e:
+        logger.error("Could not write lookup cache %s: %s" % (type(cache).__name__, e))
+
+
+# looks up all the given arns(grouped by objectType) which are not cached using as few describe calls as possible,
+# the describe calls are made concurrently and a failed call only leaves its arns uncached
+def prefetch(arnsByType):
+    global persistentCaches
+    if (persistentCaches is None):
+        persistentCaches = getPersistentCaches()
+    requests = []
+    for objectType, arns in arnsByType.items():
+        missingArns = [arn for arn in OrderedDict.fromkeys(arns) if lookupCache.get((objectType, arn)) is None]
+        with lookupStatsLock:
+            lookupStats['hits'] += len(set(arns)) - len(missingArns)
+        missingArns = loadPersistent(objectType, missingArns)
+        with lookupStatsLock:
+            lookupStats['misses'] += len(missingArns)
+        for i in range(0, len(missingArns), maxArnsPerCall):
+            requests.append((objectType, missingArns[i:i + maxArnsPerCall]))
+    if (len(requests) == 1):
+        results = [describeQuietly(requests[0])]
+    elif (requests):
+        with ThreadPoolExecutor(max_workers=maxLookupWorkers) as executor:
+            results = list(executor.map(describeQuietly, requests))
+    else:
+        results = []
+    persistentItems = {}
+    for objectType, items in results:
+        if (objectType in persistentLookupTypes):
+            persistentItems.update(("%s|%s" % (objectType, arn), item) for arn, item in items.items())
+    if (persistentItems):
+        for cache in persistentCaches:
+            storeQuietly(cache, persistentItems)
+
+
+def describeQuietly(request):
+    # describe already logs the error, records referring to these arns are sent without their context
+    try:
+        return describe(*request)
+    except Exception:
+        return request[0], {}
+
+
+# This function looks up an Inspector object based on its arn and type. Returned object will be used to provide extra context for the final message to Sumo
+def lookup(objectId,objectType = 'run', fetchMissing = True):
+    finalObj = lookupCache.get((objectType, objectId))
+    if (finalObj is None and fetchMissing):
+        prefetch({objectType: [objectId]})
+        finalObj = lookupCache.get((objectType, objectId))
     return finalObj
 
+
 # simple utility function to deserialize datetime objects
 def json_deserializer(obj):
     if isinstance(obj, datetime.datetime):
         return obj.strftime('%Y-%m-%dT%H:%M:%SZ')
-    elif isinstance(obj, date):
+    elif isinstance(obj, datetime.date):
         return obj.strftime('%Y-%m-%d')
-    # Let the base class default method raise the TypeError
-    return json.JSONEncoder.default(self, obj)
+    raise TypeError("Object of type %s is not JSON serializable" % type(obj).__name__)
+
+
+def getRulesPackageArn(finding):
+    serviceAttributes = finding.get('serviceAttributes') if isinstance(finding, dict) else None
+    return serviceAttributes.get('rulesPackageArn') if isinstance(serviceAttributes, dict) else None
+
+
+# builds the final data object of a SNS record with the looked up context
+def enrichRecord(snsObj, msgObj=None, fetchMissing=True):
+    if (msgObj is None):
+        msgObj = json.loads(snsObj['Message'])
+    if (contextLookup):
+        # do reverse lookup of each of the following items in Message: target, run, template.
+        if ('template' in msgObj):
+            lookupItem = lookup(msgObj['template'],'template',fetchMissing)
+            if (lookupItem is not None):
+                logger.info("Got a template item back")
+                msgObj['templateLookup']= lookupItem
+            else:
+                print("Could not lookup template: %s" % msgObj['template'])
+        if ('run' in msgObj):
+            lookupItem = lookup(msgObj['run'],'run',fetchMissing)
+            if (lookupItem is not None):
+                msgObj['runLookup']= lookupItem
+            else:
+                logger.info("Could not lookup run: %s" % msgObj['run'])
+        if ('target' in msgObj):
+            lookupItem = lookup(msgObj['target'],'target',fetchMissing)
+            if (lookupItem is not None):
+                msgObj['targetLookup']= lookupItem
+            else:
+                logger.info("Could not lookup target: %s" % msgObj['target'])
+    if ('finding' in msgObj):
+        # now query findings
+        finding = lookup(msgObj['finding'],'finding',fetchMissing)
+        if (finding is not None):
+            # cached finding is copied as rulesPackageLookup is added to it
+            finding = dict(finding)
+
+            # now query rulesPackage inside the finding
+            rulesPackageArn = getRulesPackageArn(finding)
+            rulesPackage = lookup(rulesPackageArn,'rulesPackage',fetchMissing) if isinstance(rulesPackageArn, str) else None
+            if (rulesPackage is not None):
+                finding['rulesPackageLookup'] = rulesPackage
+            else:
+                logger.info("Cannot lookup rulesPackageArn: %s"% rulesPackageArn)
+        msgObj['findingDetails'] = finding
+    # construct final data object
+    return {'Timestamp':snsObj['Timestamp'],'Message':msgObj,'MessageId':snsObj['MessageId']}
+
+
+# sends a batch of (MessageId, serialized record) as one newline delimited payload, returns the MessageIds which failed
+def sendBatch(batch):
+    messageIds = [messageId for messageId, _ in batch]
+    try:
+        rs = sendSumo(b"\n".join(line for _, line in batch), toCompress=True)
+    except Exception as e:
+        rs = (None, str(e))
+    if (rs[0]!=200):
+        logger.info('Error sending %d records to sumo with code: %s and message: %s MessageIds: %s' % (len(batch), rs[0], rs[1], ",".join(messageIds)))
+        return messageIds
+    logger.info("Sent %d records to Sumo successfully" % len(batch))
+    return []
+
+
+# parses the message of a SNS record, returns (msgObj, None) or (None, error) so that a malformed message does not
+# fail the other records of the event
+def parseMessage(record):
+    try:
+        msgObj = json.loads(record['Sns']['Message'])
+    except Exception as e:
+        return None, "Could not parse Message: %s" % e
+    if (not isinstance(msgObj, dict)):
+        return None, "Message is not a JSON object"
+    return msgObj, None
+
+
+# looks up the objects referenced by all the messages of a batch with batched describe calls, the independent
+# template, run, target and finding lookups are made together and the rules packages of the findings after them,
+# arns which are not strings are left to enrichRecord which fails only their record
+def prefetchMessages(msgObjs):
+    getInspectorClient()  # client is created before it is shared by the lookup threads
+    objectTypes = ['template', 'run', 'target', 'finding'] if contextLookup else ['finding']
+    arnsByType = {objectType: [] for objectType in objectTypes}
+    for msgObj in msgObjs:
+        for objectType in objectTypes:
+            if (isinstance(msgObj.get(objectType), str)):
+                arnsByType[objectType].append(msgObj[objectType])
+    prefetch(arnsByType)
+    rulesPackageArns = []
+    for findingArn in arnsByType['finding']:
+        rulesPackageArn = getRulesPackageArn(lookupCache.get(('finding', findingArn)))
+        if (isinstance(rulesPackageArn, str)):
+            rulesPackageArns.append(rulesPackageArn)
+    prefetch({'rulesPackage': rulesPackageArns})
+    logger.info("Lookup cache hits: %d persistentHits: %d misses: %d apiCalls: %d" % (lookupStats['hits'], lookupStats['persistentHits'], lookupStats['misses'], lookupStats['apiCalls']))
+
+
+# enriches and serializes a prefetched record, a record whose message can not be parsed or whose enrichment fails is
+# serialized without the context
+def processRecord(record, msgObj, parseError=None):
+    snsObj = record['Sns']
+    if (parseError is not None):
+        logger.error("Could not parse MessageId: %s Error: %s" % (snsObj['MessageId'], parseError))
+        dataObj = {'Timestamp':snsObj['Timestamp'],'Message':snsObj.get('Message'),'MessageId':snsObj['MessageId'],'lookupError':parseError}
+    else:
+        try:
+            dataObj = enrichRecord(snsObj, msgObj, fetchMissing=False)
+        except Exception as e:
+            logger.error("Could not enrich MessageId: %s Error: %s" % (snsObj['MessageId'], e))
+            dataObj = {'Timestamp':snsObj['Timestamp'],'Message':msgObj,'MessageId':snsObj['MessageId'],'lookupError':str(e)}
+    return snsObj['MessageId'], json.dumps(dataObj,default=json_deserializer).encode('utf-8')
 
 
 def sumo_inspector_handler(event, context):
     if ('Records' in event):
+        batch, batchSize, failedMessageIds = [], 0, []
+        # get actual SNS messages
+        msgObjs, parseErrors = [], []
         for record in event['Records']:
-            # get actual SNS message
-            snsObj = record['Sns']
-            dataObj = {'Timestamp':snsObj['Timestamp'],'Message':snsObj['Message'],'MessageId':snsObj['MessageId']}
-            msgObj = json.loads(snsObj['Message'])
-            if (contextLookup):
-                # do reverse lookup of each of the following items in Message: target, run, template.
-                if ('template' in msgObj):
-                    lookupItem = lookup(msgObj['template'],'template')
-                    if (lookupItem is not None):
-                        logger.info("Got a template item back")
-                        msgObj['templateLookup']= lookupItem
-                    else:
-                        print("Could not lookup template: %s" % msgObj['template'])
-                if ('run' in msgObj):
-                    lookupItem = lookup(msgObj['run'],'run')
-                    if (lookupItem is not None):
-                        msgObj['runLookup']= lookupItem
-                    else:
-                        logger.info("Could not lookup run: %s" % msgObj['run'])
-                if ('target' in msgObj):
-                    lookupItem = lookup(msgObj['target'],'target')
-                    if (lookupItem is not None):
-                        msgObj['targetLookup']= lookupItem
-                    else:
-                        logger.info("Could not lookup target: %s" % msgObj['target'])
-            if ('finding' in msgObj):
-                # now query findings
-                finding = lookup(msgObj['finding'],'finding')
-                if (finding is not None):
-
-                    # now query rulesPackage inside the finding
-                    rulesPackage = lookup(finding['serviceAttributes']['rulesPackageArn'],'rulesPackage')
-                    if (rulesPackage is not None):
-                        finding['rulesPackageLookup'] = rulesPackage
-                    else:
-                        logger.info("Cannot lookup rulesPackageArn: %s"% finding['serviceAttributes']['rulesPackageArn'])
-                msgObj['findingDetails'] = finding
-             # construct final data object
-            dataObj = {'Timestamp':snsObj['Timestamp'],'Message':msgObj,'MessageId':snsObj['MessageId']}
-
-            # now send this object to Sumo side
-            rs = sendSumo(json.dumps(dataObj,default=json_deserializer),toCompress=True)
-
-            if (rs[0]!=200):
-                logger.info('Error sending data to sumo with code: %d and message: %s '% (rs[0],rs[1]))
-                logger.info(json.dumps(dataObj,default=json_deserializer))
-            else:
-                logger.info("Sent data to Sumo successfully")
+            msgObj, parseError = parseMessage(record)
+            msgObjs.append(msgObj)
+            parseErrors.append(parseError)
+        try:
+            prefetchMessages([msgObj for msgObj in msgObjs if msgObj is not None])
+        except Exception as e:
+            # records whose objects were not prefetched are sent without their context
+            logger.error("Could not prefetch lookups: %s" % e)
+        # records are enriched concurrently, map keeps them in the order of the event
+        with ThreadPoolExecutor(max_workers=maxLookupWorkers) as executor:
+            for messageId, line in executor.map(processRecord, event['Records'], msgObjs, parseErrors):
+                if (batch and batchSize + len(line) + 1 > maxPayloadSize):
+                    failedMessageIds.extend(sendBatch(batch))
+                    batch, batchSize = [], 0
+                batch.append((messageId, line))
+                batchSize += len(line) + 1
+        if (batch):
+            failedMessageIds.extend(sendBatch(batch))
+        logger.info("Processed %d records, failed %d" % (len(event['Records']), len(failedMessageIds)))
+        return {'failedMessageIds': failedMessageIds}
     else:
         logger.info('Unrecoganized data')
-
@@ -0,0 +1,326 @@
+import unittest
+import datetime
+import gzip
+import json
+import sys
+import os
+import tempfile
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "python"))
+
+import inspector
+
+del sys.path[0]
+
+
+class FakeInspectorClient(object):
+    """Returns an object for every described arn and records the describe calls."""
+
+    def __init__(self, failingApis=()):
+        self.calls = []
+        self.failingApis = failingApis
+
+    def __getattr__(self, api):
+        objectType = [objectType for objectType, (name, _, _) in inspector.lookupApis.items() if name == api][0]
+        param, responseKey = inspector.lookupApis[objectType][1:]
+
+        def describe(**kwargs):
+            arns = kwargs[param]
+            self.calls.append((objectType, list(arns)))
+            if (api in self.failingApis):
+                raise RuntimeError("%s failed" % api)
+            return {responseKey: [self.getItem(objectType, arn) for arn in arns]}
+        return describe
+
+    def getItem(self, objectType, arn):
+        item = {'arn': arn, 'name': arn}
+        if (objectType == 'run'):
+            item.update({'createdAt': datetime.datetime(2018, 12, 17), 'state': 'COMPLETED', 'durationInSeconds': 3600,
+                         'startedAt': datetime.datetime(2018, 12, 17), 'assessmentTemplateArn': 'template'})
+        elif (objectType == 'finding'):
+            item['serviceAttributes'] = {'rulesPackageArn': 'rulesPackage-%s' % arn[-1]}
+        return item
+
+
+class FakeConnectionPool(object):
+    """Records the decompressed payloads, the payloads at the indexes in failingRequests get a 503."""
+
+    def __init__(self, failingRequests=()):
+        self.payloads = []
+        self.headers = []
+        self.failingRequests = failingRequests
+
+    def request(self, method, path, body, headers):
+        self.headers.append(headers)
+        self.payloads.append(gzip.decompress(body) if headers.get("Content-Encoding") == "gzip" else body)
+        if (len(self.payloads) - 1 in self.failingRequests):
+            return 503, "Service Unavailable", 0.0
+        return 200, "OK", 0.0
+
+    def records(self, index=None):
+        payloads = self.payloads if index is None else [self.payloads[index]]
+        return [json.loads(line) for payload in payloads for line in payload.splitlines()]
+
+
+def getRecord(idx, message=None):
+    if (message is None):
+        message = {'template': 'template', 'run': 'run-%d' % (idx % 3), 'target': 'target', 'finding': 'finding-%d' % idx}
+    return {'Sns': {'Timestamp': '2018-12-17T10:00:00.000Z', 'MessageId': 'message-%d' % idx,
+                    'Message': message if isinstance(message, str) else json.dumps(message)}}
+
+
+class TestInspector(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeInspectorClient()
+        self.pool = FakeConnectionPool()
+        self.patches = [
+            patch.object(inspector, "inspectorClient", self.client),
+            patch.object(inspector, "connectionPool", self.pool),
+            patch.object(inspector, "lookupCache", inspector.LRUCache(inspector.lookupCacheSize, inspector.lookupCacheTTL)),
+            patch.object(inspector, "persistentCaches", []),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+    def test_handler_keeps_order(self):
+        result = inspector.sumo_inspector_handler({'Records': [getRecord(i) for i in range(25)]}, None)
+        self.assertEqual(result, {'failedMessageIds': []})
+        records = self.pool.records()
+        self.assertEqual([record['MessageId'] for record in records], ['message-%d' % i for i in range(25)])
+        self.assertEqual(records[4]['Message']['findingDetails']['rulesPackageLookup']['arn'], 'rulesPackage-4')
+        self.assertEqual(records[4]['Message']['runLookup']['createdAt'], '2018-12-17 00:00:00')
+
+    def test_handler_failed_message_ids(self):
+        self.pool.failingRequests = (1,)
+        with patch.object(inspector, "maxPayloadSize", 2048):
+            result = inspector.sumo_inspector_handler({'Records': [getRecord(i) for i in range(10)]}, None)
+        self.assertGreater(len(self.pool.payloads), 2)
+        failedIds = [record['MessageId'] for record in self.pool.records(1)]
+        self.assertEqual(result, {'failedMessageIds': failedIds})
+        self.assertEqual([record['MessageId'] for record in self.pool.records()], ['message-%d' % i for i in range(10)])
+
+    def test_malformed_records_are_isolated(self):
+        oddFinding = getRecord(2)
+        self.client.getItem = lambda objectType, arn: (
+            {'arn': arn, 'serviceAttributes': None} if arn == 'finding-2' else FakeInspectorClient.getItem(self.client, objectType, arn))
+        records = [getRecord(0), getRecord(1, '{"template": '), oddFinding, getRecord(3, '"not an object"'), getRecord(4)]
+        result = inspector.sumo_inspector_handler({'Records': records}, None)
+        self.assertEqual(result, {'failedMessageIds': []})
+        sent = self.pool.records()
+        self.assertEqual([record['MessageId'] for record in sent], ['message-%d' % i for i in range(5)])
+        self.assertIn('rulesPackageLookup', sent[0]['Message']['findingDetails'])
+        self.assertEqual(sent[1]['Message'], '{"template": ')
+        self.assertIn('Could not parse Message', sent[1]['lookupError'])
+        self.assertIn('lookupError', sent[3])
+        self.assertEqual(sent[2]['Message']['findingDetails']['arn'], 'finding-2')
+        self.assertNotIn('rulesPackageLookup', sent[2]['Message']['findingDetails'])
+        self.assertIn('rulesPackageLookup', sent[4]['Message']['findingDetails'])
+
+    def test_failed_prefetch_sends_records_without_context(self):
+        self.client.failingApis = ('describe_assessment_runs',)
+        result = inspector.sumo_inspector_handler({'Records': [getRecord(i) for i in range(6)]}, None)
+        self.assertEqual(result, {'failedMessageIds': []})
+        self.assertEqual(len([call for call in self.client.calls if call[0] == 'run']), 1,
+                         "failed lookups should not be retried for every record")
+        records = self.pool.records()
+        self.assertEqual(len(records), 6)
+        self.assertTrue(all('runLookup' not in record['Message'] and 'templateLookup' in record['Message']
+                            for record in records))
+
+    def test_connection_pool_reuses_and_reconnects(self):
+        class Response(object):
+            def __init__(self, willClose):
+                self.status, self.reason, self.will_close = 200, "OK", willClose
+
+            def read(self):
+                return b""
+
+        class Connection(object):
+            def __init__(self):
+                self.requests, self.closed, self.failNext, self.willClose = 0, False, False, False
+
+            def request(self, method, path, body, headers):
+                if (self.failNext):
+                    self.failNext = False
+                    raise ConnectionResetError("connection reset by peer")
+                self.requests += 1
+
+            def getresponse(self):
+                return Response(self.willClose)
+
+            def close(self):
+                self.closed = True
+
+        connections = []
+
+        def newConnection():
+            connections.append(Connection())
+            return connections[-1]
+
+        pool = inspector.SumoConnectionPool("endpoint1.collection.sumologic.com", maxsize=1)
+        pool._newConnection = newConnection
+        self.assertEqual(pool.request("POST", "/receiver", b"{}", {})[:2], (200, "OK"))
+        pool.request("POST", "/receiver", b"{}", {})
+        self.assertEqual(len(connections), 1, "the connection should be reused")
+        self.assertEqual(connections[0].requests, 2)
+
+        connections[0].failNext = True
+        self.assertEqual(pool.request("POST", "/receiver", b"{}", {})[0], 200)
+        self.assertTrue(connections[0].closed, "the broken connection should be closed")
+        self.assertEqual((len(connections), pool.stats['reconnects'], pool.stats['requests']), (2, 1, 3))
+
+        connections[1].willClose = True
+        pool.request("POST", "/receiver", b"{}", {})
+        self.assertTrue(connections[1].closed, "connections closed by the server should not be pooled")
+        pool.request("POST", "/receiver", b"{}", {})
+        self.assertEqual(len(connections), 3)
+
+        connections[2].failNext = True
+        newConnection = pool._newConnection
+
+        def failingConnection():
+            conn = newConnection()
+            conn.failNext = True
+            return conn
+
+        pool._newConnection = failingConnection
+        with self.assertRaises(ConnectionResetError):
+            pool.request("POST", "/receiver", b"{}", {})
+        self.assertTrue(all(conn.closed for conn in connections[2:]), "failed connections should be closed")
+        self.assertEqual(pool.connections.qsize(), 0)
+
+    def test_payload_split(self):
+        records = [getRecord(i) for i in range(20)]
+        with patch.object(inspector, "maxPayloadSize", 4096):
+            result = inspector.sumo_inspector_handler({'Records': records}, None)
+        self.assertEqual(result, {'failedMessageIds': []})
+        self.assertGreater(len(self.pool.payloads), 1)
+        self.assertTrue(all(len(payload) <= 4096 for payload in self.pool.payloads))
+        self.assertEqual([record['MessageId'] for record in self.pool.records()], ['message-%d' % i for i in range(20)])
+
+    def test_large_record_is_sent_alone(self):
+        largeRecord = getRecord(1, dict(json.loads(getRecord(1)['Sns']['Message']), description="x" * 5000))
+        with patch.object(inspector, "maxPayloadSize", 4096):
+            inspector.sumo_inspector_handler({'Records': [getRecord(0), largeRecord, getRecord(2)]}, None)
+        self.assertEqual([[record['MessageId'] for record in self.pool.records(idx)] for idx in range(3)],
+                         [['message-0'], ['message-1'], ['message-2']])
+
+    def test_compression_policy(self):
+        levels = []
+
+        def compress(data, compresslevel=9):
+            levels.append(compresslevel)
+            return gzip.compress(data, compresslevel)
+
+        with patch.object(inspector, "compress", compress):
+            payload, encoding = inspector.compressPayload(b"x" * (inspector.compressThreshold - 1))
+            self.assertEqual((payload, encoding), (b"x" * (inspector.compressThreshold - 1), None),
+                             "payloads smaller than compressThreshold should not be compressed")
+            payload, encoding = inspector.compressPayload(b"x" * inspector.compressThreshold)
+            self.assertEqual((gzip.decompress(payload), encoding), (b"x" * inspector.compressThreshold, "gzip"))
+            inspector.compressPayload(b"x" * inspector.largePayloadSize)
+            inspector.compressPayload(b"x" * (inspector.largePayloadSize + 1))
+            with patch.object(inspector, "useZstd", True), patch.object(inspector, "zstandard", None):
+                self.assertEqual(inspector.compressPayload(b"x" * inspector.compressThreshold)[1], "gzip",
+                                 "should fall back to gzip without the zstandard package")
+        self.assertEqual(levels, [inspector.fastCompressLevel, inspector.fastCompressLevel,
+                                  inspector.largeCompressLevel, inspector.fastCompressLevel])
+
+    def test_send_headers(self):
+        inspector.sendSumo(b"{}", toCompress=True)
+        inspector.sendSumo(b"x" * inspector.compressThreshold, toCompress=True)
+        self.assertNotIn("Content-Encoding", self.pool.headers[0])
+        self.assertEqual(self.pool.headers[1]["Content-Encoding"], "gzip")
+        self.assertEqual(self.pool.payloads, [b"{}", b"x" * inspector.compressThreshold])
+
+    def test_lru_cache_eviction_and_expiry(self):
+        cache = inspector.LRUCache(maxsize=2, ttl=60)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'), "the least recently used entry should be evicted")
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+
+        now = inspector.time.time()
+        with patch.object(inspector.time, "time", lambda: now + 61):
+            self.assertIsNone(cache.get('a'), "entries should expire after ttl seconds")
+        self.assertNotIn('a', cache.entries)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_describe_batching(self):
+        records = [getRecord(i) for i in range(25)]
+        inspector.sumo_inspector_handler({'Records': records}, None)
+        callSizes = sorted((objectType, len(arns)) for objectType, arns in self.client.calls)
+        self.assertEqual(callSizes, [('finding', 5), ('finding', 10), ('finding', 10), ('rulesPackage', 10),
+                                     ('run', 3), ('target', 1), ('template', 1)])
+        self.assertTrue(all(len(arns) <= inspector.maxArnsPerCall for _, arns in self.client.calls))
+
+        self.client.calls = []
+        inspector.sumo_inspector_handler({'Records': records}, None)
+        self.assertEqual(self.client.calls, [], "cached objects should not be described again")
+
+    def test_lookup_fetches_missing(self):
+        self.assertEqual(inspector.lookup('template', 'template')['arn'], 'template')
+        self.assertIsNone(inspector.lookup('target', 'target', fetchMissing=False))
+        self.assertEqual(self.client.calls, [('template', ['template'])])
+
+    def test_load_persistent_backfills(self):
+        localCache, sharedCache = inspector.MemoryCache(60), inspector.MemoryCache(60)
+        sharedCache.putMany({'template|template': {'arn': 'template', 'name': 'cached template'}})
+        with patch.object(inspector, "persistentCaches", [localCache, sharedCache]):
+            missingArns = inspector.loadPersistent('template', ['template', 'other-template'])
+            self.assertEqual(missingArns, ['other-template'])
+            self.assertEqual(inspector.lookupCache.get(('template', 'template'))['name'], 'cached template')
+            self.assertEqual(list(localCache.getMany(['template|template'])), ['template|template'],
+                             "objects found in a later cache should be copied to the earlier caches")
+            self.assertEqual(inspector.loadPersistent('run', ['run-0']), ['run-0'],
+                             "only persistentLookupTypes should be looked up in the persistent caches")
+
+    def test_persistent_cache_tiers(self):
+        localCache, sharedCache = inspector.MemoryCache(60), inspector.MemoryCache(60)
+        sharedCache.putMany({'target|target': {'arn': 'target', 'name': 'cached target'}})
+        records = [getRecord(i) for i in range(3)]
+        with patch.object(inspector, "persistentCaches", [localCache, sharedCache]):
+            inspector.sumo_inspector_handler({'Records': records}, None)
+        describedTypes = set(objectType for objectType, _ in self.client.calls)
+        self.assertEqual(describedTypes, {'template', 'run', 'finding', 'rulesPackage'})
+        self.assertEqual(self.pool.records()[0]['Message']['targetLookup']['name'], 'cached target')
+        for cache in (localCache, sharedCache):
+            self.assertEqual(sorted(key.split('|')[0] for key in cache.items),
+                             ['rulesPackage', 'rulesPackage', 'rulesPackage', 'target', 'template'],
+                             "described objects of persistentLookupTypes should be written to every cache")
+
+    def test_failing_persistent_cache(self):
+        class FailingCache(inspector.MemoryCache):
+            def getMany(self, keys):
+                raise IOError("cache is not available")
+
+            def putMany(self, items):
+                raise IOError("cache is not available")
+
+        with patch.object(inspector, "persistentCaches", [FailingCache(60)]):
+            result = inspector.sumo_inspector_handler({'Records': [getRecord(0)]}, None)
+        self.assertEqual(result, {'failedMessageIds': []})
+        self.assertIn('templateLookup', self.pool.records()[0]['Message'])
+
+    def test_file_cache(self):
+        path = os.path.join(tempfile.mkdtemp(), "lookup_cache.json")
+        inspector.FileCache(path, 60).putMany({'template|template': {'arn': 'template'}})
+        self.assertEqual(inspector.FileCache(path, 60).getMany(['template|template', 'template|other']),
+                         {'template|template': {'arn': 'template'}})
+        now = inspector.time.time()
+        with patch.object(inspector.time, "time", lambda: now + 61):
+            self.assertEqual(inspector.FileCache(path, 60).getMany(['template|template']), {},
+                             "expired objects should not be returned")
+
+
+if __name__ == '__main__':
+
+    unittest.main()
@@ -1,14 +1,50 @@
 import json
 import os
+import re
+import hashlib
+import zlib
+import time
+import signal
+import threading
 import logging
 import sys
 sys.path.insert(0, '/opt')  # layer packages are in opt directory
 import boto3
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
 
 
 BUCKET_NAME = os.getenv("S3_LOG_BUCKET")
 BUCKET_REGION = os.getenv("AWS_REGION")
+# json writes findings separated by blank lines, ndjson.gz writes gzip compressed newline delimited json
+OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "json")
+MAX_UPLOAD_WORKERS = int(os.getenv("MAX_UPLOAD_WORKERS", 4))
+# legacy writes <product_arn>-<request_id>, partitioned writes <prefix>/yyyy/mm/dd/hh/<product>-<region>-<account>/<request_id>.json
+KEY_LAYOUT = os.getenv("KEY_LAYOUT", "legacy")
+KEY_PREFIX = os.getenv("KEY_PREFIX", "securityhub")
+# when set the partitioned keys are spread over these many hash prefixes to distribute the request rate
+KEY_HASH_SHARDS = int(os.getenv("KEY_HASH_SHARDS", 0))
+# buffering keeps findings in memory across warm invocations and writes them in larger objects, findings buffered in
+# an execution environment which is reclaimed without a SIGTERM are lost
+BUFFER_FINDINGS = os.getenv("BUFFER_FINDINGS", "false").lower() == "true"
+BUFFER_MAX_BYTES = int(os.getenv("BUFFER_MAX_BYTES", 5 * 1024 * 1024))
+BUFFER_MAX_AGE = int(os.getenv("BUFFER_MAX_AGE", 300))
+BUFFER_MIN_REMAINING_TIME = int(os.getenv("BUFFER_MIN_REMAINING_TIME", 30000))
+# objects larger than MULTIPART_THRESHOLD bytes are uploaded in parts, S3 requires parts of at least 5 MB
+MULTIPART_THRESHOLD = int(os.getenv("MULTIPART_THRESHOLD", 16 * 1024 * 1024))
+MULTIPART_PART_SIZE = max(int(os.getenv("MULTIPART_PART_SIZE", 8 * 1024 * 1024)), 5 * 1024 * 1024)
+MULTIPART_WORKERS = int(os.getenv("MULTIPART_WORKERS", 4))
+# json library used for serializing ndjson.gz findings, defaults to the fastest one available in the layer
+JSON_BACKEND = os.getenv("JSON_BACKEND")
 s3cli = boto3.client('s3', region_name=BUCKET_REGION)
 
 
@@ -16,15 +52,176 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
-def post_to_s3(findings, filename, silent=False):
+# all the serializers return compact utf-8 encoded bytes
+JSON_SERIALIZERS = {
+    "json": lambda data: json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+}
+if ujson is not None:
+    JSON_SERIALIZERS["ujson"] = lambda data: ujson.dumps(data, ensure_ascii=False,
+                                                         escape_forward_slashes=False).encode("utf-8")
+if orjson is not None:
+    JSON_SERIALIZERS["orjson"] = orjson.dumps
+
+
+def get_json_serializer(backend=None):
+    backend = backend or JSON_BACKEND
+    if backend:
+        if backend in JSON_SERIALIZERS:
+            return JSON_SERIALIZERS[backend]
+        logger.warning("JSON_BACKEND %s is not available, using the fastest available one" % backend)
+    for backend in ("orjson", "ujson", "json"):
+        if backend in JSON_SERIALIZERS:
+            return JSON_SERIALIZERS[backend]
+
+
+json_dumps = get_json_serializer()
+
+
+def to_json(findings):
+    # the json format keeps the json.dumps output so that the existing objects and parsers stay compatible
+    for idx, data in enumerate(findings):
+        if idx > 0:
+            yield b"\n\n"
+        yield json.dumps(data).encode("utf-8")
+
+
+def to_gzip_ndjson(findings):
+    # findings are streamed through the compressor so only the compressed output is held in memory
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for data in findings:
+        yield compressor.compress(json_dumps(data) + b"\n")
+    yield compressor.flush()
+
+
+# format -> (serializer yielding bytes, file extension, put_object params)
+OUTPUT_FORMATS = {
+    "json": (to_json, "", {}),
+    "ndjson.gz": (to_gzip_ndjson, ".json.gz", {"ContentType": "application/x-ndjson", "ContentEncoding": "gzip"})
+}
+
+
+class S3StreamWriter(object):
+    """
+    Collects the written bytes and saves them with put_object. Once more than threshold bytes are written it switches
+    to a multipart upload whose parts are uploaded concurrently while the rest of the data is being written.
+    """
+
+    def __init__(self, client, bucket, key, object_params=None, threshold=None, part_size=None, max_workers=None):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.object_params = object_params or {}
+        self.threshold = MULTIPART_THRESHOLD if threshold is None else threshold
+        self.part_size = MULTIPART_PART_SIZE if part_size is None else part_size
+        self.max_workers = MULTIPART_WORKERS if max_workers is None else max_workers
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.executor = None
+        self.futures = []
+
+    def write(self, data):
+        self.buffer.extend(data)
+        if self.upload_id is None and len(self.buffer) > self.threshold:
+            resp = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key, **self.object_params)
+            self.upload_id = resp["UploadId"]
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        if self.upload_id is not None:
+            while len(self.buffer) >= self.part_size:
+                self._submit_part(bytes(self.buffer[:self.part_size]))
+                del self.buffer[:self.part_size]
+
+    def _upload_part(self, part_number, body):
+        resp = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                       PartNumber=part_number, Body=body)
+        return {"ETag": resp["ETag"], "PartNumber": part_number}
+
+    def _submit_part(self, body):
+        # waits for older parts so that at most max_workers parts are held in memory
+        if len(self.futures) >= self.max_workers:
+            self.futures[-self.max_workers].result()
+        self.futures.append(self.executor.submit(self._upload_part, len(self.futures) + 1, body))
+
+    def close(self):
+        if self.upload_id is None:
+            return self.client.put_object(Body=bytes(self.buffer), Bucket=self.bucket, Key=self.key,
+                                          **self.object_params)
+        if self.buffer:
+            self._submit_part(bytes(self.buffer))
+            self.buffer = bytearray()
+        parts = [future.result() for future in self.futures]
+        resp = self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                     MultipartUpload={"Parts": parts})
+        self.executor.shutdown()
+        return resp
+
+    def abort(self):
+        # discards the uploaded parts of a failed multipart upload
+        if self.upload_id is not None:
+            self.executor.shutdown()
+            try:
+                self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            except Exception as e:
+                logger.error("Failed to abort multipart upload %s: %s" % (self.key, str(e)))
+            self.upload_id = None
+
+
+def get_file_extension(output_format=None):
+    return OUTPUT_FORMATS[output_format or OUTPUT_FORMAT][1]
+
+
+def get_product_name(product_arn):
+    # arn:aws:securityhub:us-east-1:123456789012:product/sumologicinc/sumologic-mda ->
+    # sumologicinc-sumologic-mda-us-east-1-123456789012, the region and account keep the findings of the same
+    # product aggregated from different regions or accounts in separate objects
+    arn_parts = product_arn.split(":", 5)
+    resource = arn_parts[-1]
+    if resource.startswith("product/"):
+        resource = resource[len("product/"):]
+    name_parts = [resource] + [part for part in arn_parts[3:5] if len(arn_parts) == 6 and part]
+    return re.sub(r"[^A-Za-z0-9._-]+", "-", "-".join(name_parts)).strip("-")
+
+
+def get_object_key(product_arn, request_id, timestamp=None):
+    if KEY_LAYOUT != "partitioned":
+        return "%s-%s%s" % (product_arn, request_id, get_file_extension())
+    key_parts = [KEY_PREFIX] if KEY_PREFIX else []
+    if KEY_HASH_SHARDS > 0:
+        shard = int(hashlib.md5(request_id.encode("utf-8")).hexdigest(), 16) % KEY_HASH_SHARDS
+        key_parts.append("%x" % shard)
+    key_parts.append(time.strftime("%Y/%m/%d/%H", time.gmtime(timestamp)))
+    key_parts.append(get_product_name(product_arn))
+    key_parts.append("%s%s" % (request_id, get_file_extension() or ".json"))
+    return "/".join(key_parts)
 
-    findings_data = "\n\n".join([json.dumps(data) for data in findings])
+
+def get_object_keys(product_arns, request_id):
+    # product arns which only differ in characters replaced in the product name would share a key, these are made
+    # unique by adding the hash of the product arn so that concurrent uploads do not overwrite each other
+    object_keys, used_keys = {}, set()
+    timestamp = time.time()
+    for product_arn in product_arns:
+        key = get_object_key(product_arn, request_id, timestamp)
+        if key in used_keys:
+            arn_hash = hashlib.md5(product_arn.encode("utf-8")).hexdigest()[:8]
+            key = get_object_key(product_arn, "%s-%s" % (request_id, arn_hash), timestamp)
+        used_keys.add(key)
+        object_keys[product_arn] = key
+    return object_keys
+
+
+def post_to_s3(findings, filename, silent=False, output_format=None):
+
+    serializer, _, object_params = OUTPUT_FORMATS[output_format or OUTPUT_FORMAT]
     is_success = False
+    writer = S3StreamWriter(s3cli, BUCKET_NAME, filename, object_params)
     try:
-        response = s3cli.put_object(Body=findings_data, Bucket=BUCKET_NAME, Key=filename)
+        for data in serializer(findings):
+            writer.write(data)
+        response = writer.close()
         is_success = True
         logger.info("Saved %d findings to s3 %s status_code: %s" % (len(findings), filename, response["ResponseMetadata"].get("HTTPStatusCode")))
     except Exception as e:
+        writer.abort()
         logger.error("Failed to post findings to S3: %s" % str(e))
         if not silent:
             raise e
@@ -32,26 +229,127 @@ def post_to_s3(findings, filename, silent=False):
     return is_success
 
 
+def upload_findings(product_arn, findings, filename):
+    start_time = time.time()
+    is_success = post_to_s3(findings, filename, silent=True)
+    return product_arn, is_success, time.time() - start_time
+
+
+def group_findings(findings, finding_buckets=None):
+    finding_buckets = defaultdict(list) if finding_buckets is None else finding_buckets
+    for f in findings:
+        finding_buckets[f['ProductArn']].append(f)
+    return finding_buckets
+
+
+def upload_finding_groups(finding_buckets, request_id):
+    # boto3 clients are thread safe so all the groups are uploaded using the same client
+    object_keys = get_object_keys(finding_buckets, request_id)
+    with ThreadPoolExecutor(max_workers=MAX_UPLOAD_WORKERS) as executor:
+        futures = [executor.submit(upload_findings, product_arn, finding_list, object_keys[product_arn])
+                   for product_arn, finding_list in finding_buckets.items()]
+        results = [future.result() for future in futures]
+
+    failed_products = []
+    for product_arn, is_success, latency in results:
+        logger.info("Upload ProductArn: %s Success: %s Latency: %.3f seconds" % (product_arn, is_success, latency))
+        if not is_success:
+            failed_products.append(product_arn)
+    return failed_products
+
+
 def send_findings(findings, context):
 
-    count = 0
     if len(findings) > 0:
-        finding_buckets = defaultdict(list)
-        for f in findings:
-            finding_buckets[f['ProductArn']].append(f)
-            count += 1
+        failed_products = upload_finding_groups(group_findings(findings), context.aws_request_id)
+        if failed_products:
+            raise Exception("Failed to save findings to s3 for ProductArns: %s" % ",".join(failed_products))
+
+        logger.info("Finished Sending NumFindings: %d" % (len(findings)))
+
+
+class FindingsBuffer(object):
+    """Accumulates findings grouped by ProductArn until they are large or old enough to be flushed."""
+
+    def __init__(self, max_bytes=BUFFER_MAX_BYTES, max_age=BUFFER_MAX_AGE, min_remaining_time=BUFFER_MIN_REMAINING_TIME):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.min_remaining_time = min_remaining_time
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.finding_buckets = defaultdict(list)
+        self.count = 0
+        self.size = 0
+        self.created_at = None
+
+    def add(self, findings, created_at=None):
+        with self.lock:
+            group_findings(findings, self.finding_buckets)
+            self.count += len(findings)
+            # size of the serialized findings is estimated from the size of the event
+            self.size += len(json_dumps(findings))
+            if findings:
+                created_at = created_at or time.time()
+                self.created_at = created_at if self.created_at is None else min(self.created_at, created_at)
+
+    def should_flush(self, context=None):
+        if not self.count:
+            return False
+        remaining_time = context.get_remaining_time_in_millis() if hasattr(context, "get_remaining_time_in_millis") else None
+        return (self.size >= self.max_bytes or time.time() - self.created_at >= self.max_age or
+                (remaining_time is not None and remaining_time < self.min_remaining_time))
+
+    def drain(self):
+        with self.lock:
+            finding_buckets, count, created_at = self.finding_buckets, self.count, self.created_at
+            self._reset()
+        return finding_buckets, count, created_at
+
+
+findings_buffer = FindingsBuffer()
+
+
+def flush_buffer(request_id, retried_findings=None):
+    """
+    Failed groups are kept in the buffer so that they are retried on the next flush, except retried_findings which are
+    the findings of the current event. The exception makes EventBridge retry the event so keeping them would buffer
+    them again on every retry.
+    """
+    finding_buckets, count, created_at = findings_buffer.drain()
+    if not count:
+        return
+    failed_products = upload_finding_groups(finding_buckets, request_id)
+    if failed_products:
+        retried_ids = set(id(f) for f in retried_findings or [])
+        findings_buffer.add([f for product_arn in failed_products for f in finding_buckets[product_arn]
+                             if id(f) not in retried_ids], created_at)
+        raise Exception("Failed to flush findings to s3 for ProductArns: %s" % ",".join(failed_products))
+    logger.info("Flushed buffer NumFindings: %d" % count)
+
+
+def flush_on_shutdown(signum, frame):
+    # lambda sends SIGTERM before shutting down the execution environment when an extension is registered
+    logger.info("Received signal %d flushing buffered findings" % signum)
+    flush_buffer("shutdown-%d" % int(time.time() * 1000))
 
-        for product_arn, finding_list in finding_buckets.items():
-            filename = "%s-%s" % (product_arn, context.aws_request_id)
-            post_to_s3(finding_list, filename)
 
-        logger.info("Finished Sending NumFindings: %d" % (count))
+if BUFFER_FINDINGS:
+    signal.signal(signal.SIGTERM, flush_on_shutdown)
 
 
 def lambda_handler(event, context):
     logger.info("Invoking SecurityHubCollector source %s region %s" % (event['source'], event['region']))
     findings = event['detail'].get('findings', [])
-    send_findings(findings, context)
+    if BUFFER_FINDINGS:
+        findings_buffer.add(findings)
+        if findings_buffer.should_flush(context):
+            flush_buffer(context.aws_request_id, findings)
+        else:
+            logger.info("Buffered NumFindings: %d BufferedFindings: %d" % (len(findings), findings_buffer.count))
+    else:
+        send_findings(findings, context)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,39 @@
+"""
+Compares the json backends used by the collector for the ndjson.gz format with json.dumps, which the json format uses.
+Run with orjson/ujson installed to see their speedup: python benchmark_serializers.py
+"""
+import json
+import os
+import sys
+import timeit
+
+os.environ.setdefault("AWS_REGION", "us-east-1")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from securityhub_collector import JSON_SERIALIZERS
+
+del sys.path[0]
+
+
+def stdlib_default(findings):
+    # serialization used by the json format
+    return "\n\n".join([json.dumps(data) for data in findings]).encode("utf-8")
+
+
+def benchmark(name, findings, number):
+    results = {"json format": timeit.timeit(lambda: stdlib_default(findings), number=number) / number}
+    for backend, dumps in JSON_SERIALIZERS.items():
+        results[backend] = timeit.timeit(lambda: b"\n\n".join([dumps(data) for data in findings]),
+                                         number=number) / number
+    baseline = results["json format"]
+    print("%s (%d findings)" % (name, len(findings)))
+    for backend, elapsed in results.items():
+        print("    %-22s %10.3f ms  %5.2fx" % (backend, elapsed * 1000, baseline / elapsed))
+
+
+if __name__ == '__main__':
+    with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sam", "event.json")) as f:
+        findings = json.load(f)['detail']['findings']
+    benchmark("fixture", findings, 10000)
+    large_findings = [dict(findings[i % len(findings)], Id="finding-%d" % i) for i in range(10000)]
+    benchmark("large", large_findings, 10)
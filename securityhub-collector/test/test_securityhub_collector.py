@@ -0,0 +1,196 @@
+import unittest
+import copy
+import gzip
+import json
+import sys
+import os
+from unittest.mock import patch
+
+import boto3
+try:
+    from moto import mock_aws
+except ImportError:
+    from moto import mock_s3 as mock_aws
+
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+os.environ["AWS_REGION"] = "us-east-1"
+os.environ["S3_LOG_BUCKET"] = "securityhubfindings"
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import securityhub_collector
+from securityhub_collector import lambda_handler, post_to_s3, S3StreamWriter, get_product_name, get_object_key, \
+    upload_finding_groups, FindingsBuffer, get_json_serializer, JSON_SERIALIZERS
+
+del sys.path[0]
+
+
+class TestLambda(unittest.TestCase):
+
+    def setUp(self):
+        self.mock = mock_aws()
+        self.mock.start()
+        self.s3cli = securityhub_collector.s3cli = boto3.client('s3', region_name="us-east-1")
+        self.s3cli.create_bucket(Bucket="securityhubfindings")
+        with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sam", "event.json")) as f:
+            self.event = json.load(f)
+
+        class Context:
+            aws_request_id = "testid12323"
+
+        self.context = Context()
+
+    def tearDown(self):
+        self.mock.stop()
+
+    def get_objects(self):
+        objects = {}
+        for obj in self.s3cli.list_objects_v2(Bucket="securityhubfindings").get("Contents", []):
+            objects[obj["Key"]] = self.s3cli.get_object(Bucket="securityhubfindings", Key=obj["Key"])["Body"].read()
+        return objects
+
+    def test_send_success(self):
+        lambda_handler(self.event, self.context)
+        objects = self.get_objects()
+        self.assertEqual(len(objects), 1)
+        key, body = objects.popitem()
+        self.assertTrue(key.endswith("-testid12323"), "%s key is not matching" % key)
+        self.assertEqual(json.loads(body), self.event['detail']['findings'][0])
+
+    def test_json_format_is_unchanged(self):
+        findings = [dict(self.event['detail']['findings'][0], Id=str(i), Title="caf\u00e9 / \u2713") for i in range(3)]
+        self.assertTrue(post_to_s3(findings, "findings.json", output_format="json"))
+        self.assertEqual(self.get_objects()["findings.json"],
+                         "\n\n".join([json.dumps(data) for data in findings]).encode("utf-8"))
+
+    def test_unavailable_json_backend(self):
+        with self.assertLogs(level="WARNING"):
+            dumps = get_json_serializer("missingbackend")
+        self.assertIn(dumps, JSON_SERIALIZERS.values())
+        self.assertEqual(json.loads(dumps({"a": 1})), {"a": 1})
+
+    def test_gzip_ndjson_format(self):
+        findings = [dict(self.event['detail']['findings'][0], Id=str(i)) for i in range(3)]
+        self.assertTrue(post_to_s3(findings, "findings.json.gz", output_format="ndjson.gz"))
+        body = gzip.decompress(self.get_objects()["findings.json.gz"])
+        self.assertEqual([json.loads(line) for line in body.splitlines()], findings)
+
+    def test_multipart_upload(self):
+        part_size = 5 * 1024 * 1024
+        writer = S3StreamWriter(self.s3cli, "securityhubfindings", "large.json", threshold=part_size,
+                                part_size=part_size, max_workers=2)
+        chunk = b"x" * (1024 * 1024)
+        for _ in range(12):
+            writer.write(chunk)
+        writer.close()
+        self.assertIsNotNone(writer.upload_id, "objects larger than threshold should use multipart upload")
+        self.assertEqual(len(writer.futures), 3)
+        self.assertEqual(self.get_objects()["large.json"], chunk * 12)
+
+    def test_small_upload(self):
+        writer = S3StreamWriter(self.s3cli, "securityhubfindings", "small.json")
+        writer.write(b"{}")
+        writer.close()
+        self.assertIsNone(writer.upload_id)
+        self.assertEqual(self.get_objects()["small.json"], b"{}")
+
+    def test_get_product_name(self):
+        self.assertEqual(get_product_name("arn:aws:securityhub:us-east-1:123456789012:product/sumologicinc/sumologic-mda"),
+                         "sumologicinc-sumologic-mda-us-east-1-123456789012")
+        self.assertEqual(get_product_name("arn:aws:securityhub:us-west-2::product/aws/guardduty"),
+                         "aws-guardduty-us-west-2")
+
+    def test_get_object_key(self):
+        product_arn = "arn:aws:securityhub:us-east-1::product/aws/guardduty"
+        self.assertEqual(get_object_key(product_arn, "testid12323"), "%s-testid12323" % product_arn)
+        with patch.object(securityhub_collector, "KEY_LAYOUT", "partitioned"):
+            self.assertEqual(get_object_key(product_arn, "testid12323", 1545042500),
+                             "securityhub/2018/12/17/10/aws-guardduty-us-east-1/testid12323.json")
+            self.assertNotEqual(get_object_key(product_arn, "testid12323", 1545042500),
+                                get_object_key(product_arn.replace("us-east-1", "us-west-2"), "testid12323", 1545042500))
+            with patch.object(securityhub_collector, "KEY_HASH_SHARDS", 16):
+                self.assertRegex(get_object_key(product_arn, "testid12323", 1545042500),
+                                 r"^securityhub/[0-9a-f]/2018/12/17/10/aws-guardduty-us-east-1/testid12323\.json$")
+
+    def test_partitioned_keys_are_unique_per_group(self):
+        finding = self.event['detail']['findings'][0]
+        finding_buckets = {
+            "arn:aws:securityhub:us-east-1::product/aws/guardduty": [dict(finding, Id="1")],
+            "arn:aws:securityhub:us-west-2::product/aws/guardduty": [dict(finding, Id="2")],
+            "arn:aws:securityhub:us-west-2::product/aws-guardduty": [dict(finding, Id="3")],
+        }
+        with patch.object(securityhub_collector, "KEY_LAYOUT", "partitioned"):
+            self.assertEqual(upload_finding_groups(finding_buckets, "testid12323"), [])
+        objects = self.get_objects()
+        self.assertEqual(len(objects), 3)
+        self.assertEqual(sorted(json.loads(body)["Id"] for body in objects.values()), ["1", "2", "3"])
+
+    def test_buffer_flush_conditions(self):
+        class Context:
+            remaining_time = 60000
+
+            def get_remaining_time_in_millis(self):
+                return self.remaining_time
+
+        context = Context()
+        findings = self.event['detail']['findings']
+        findings_buffer = FindingsBuffer(max_bytes=10 * 1024 * 1024, max_age=300, min_remaining_time=30000)
+        self.assertFalse(findings_buffer.should_flush(context), "an empty buffer should not be flushed")
+        findings_buffer.add(findings)
+        self.assertFalse(findings_buffer.should_flush(context))
+
+        findings_buffer.max_bytes = findings_buffer.size
+        self.assertTrue(findings_buffer.should_flush(context), "should flush once max_bytes are buffered")
+        findings_buffer.max_bytes = 10 * 1024 * 1024
+
+        findings_buffer.created_at -= 300
+        self.assertTrue(findings_buffer.should_flush(context), "should flush once the findings are max_age old")
+        findings_buffer.created_at += 300
+
+        context.remaining_time = 10000
+        self.assertTrue(findings_buffer.should_flush(context), "should flush when the invocation is about to time out")
+
+        finding_buckets, count, created_at = findings_buffer.drain()
+        self.assertEqual(count, len(findings))
+        self.assertEqual(findings_buffer.count, 0)
+
+    def buffered_invoke(self, event, bucket_name):
+        securityhub_collector.BUCKET_NAME = bucket_name
+        try:
+            lambda_handler(event, self.context)
+        finally:
+            securityhub_collector.BUCKET_NAME = "securityhubfindings"
+
+    def test_buffer_failed_flush(self):
+        findings_buffer = FindingsBuffer(max_bytes=1, max_age=300, min_remaining_time=0)
+        finding = self.event['detail']['findings'][0]
+        earlier_finding = dict(finding, Id="earlier")
+        findings_buffer.add([earlier_finding])
+        with patch.object(securityhub_collector, "BUFFER_FINDINGS", True), \
+                patch.object(securityhub_collector, "findings_buffer", findings_buffer):
+            for _ in range(3):
+                with self.assertRaises(Exception):
+                    self.buffered_invoke(copy.deepcopy(self.event), "missingbucket")
+                self.assertEqual([f["Id"] for f in findings_buffer.drain()[0][finding["ProductArn"]]], ["earlier"],
+                                 "only findings of earlier events should be kept after a failed flush")
+                findings_buffer.add([earlier_finding])
+            self.buffered_invoke(copy.deepcopy(self.event), "securityhubfindings")
+        self.assertEqual(findings_buffer.count, 0)
+        objects = self.get_objects()
+        self.assertEqual(len(objects), 1)
+        self.assertEqual([json.loads(f)["Id"] for f in objects.popitem()[1].split(b"\n\n")], ["earlier", finding["Id"]])
+
+    def test_send_failure(self):
+        event = copy.deepcopy(self.event)
+        securityhub_collector.BUCKET_NAME = "missingbucket"
+        try:
+            with self.assertRaises(Exception):
+                lambda_handler(event, self.context)
+        finally:
+            securityhub_collector.BUCKET_NAME = "securityhubfindings"
+
+
+if __name__ == '__main__':
+
+    unittest.main()
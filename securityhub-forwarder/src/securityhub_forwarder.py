@@ -1,14 +1,25 @@
 import json
+import asyncio
+import re
 from datetime import datetime
 import os
 import logging
 import traceback
-import uuid
+import hashlib
 import sys
+import time
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 sys.path.insert(0, '/opt')
 import boto3
-from botocore.exceptions import ClientError
-from utils import retry
+from botocore.exceptions import ClientError, BotoCoreError
+from utils import retry, async_retry, decorrelated_jitter_sleep, Deadline, CircuitBreaker, json_dumps
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 def get_product_arn(securityhub_region):
@@ -23,77 +34,211 @@ def get_logger():
 
 logger = get_logger()
 
+# clients are kept at module level so that they are reused across warm invocations
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(service_name, region_name):
+    key = (service_name, region_name)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _clients[key] = boto3.client(service_name, region_name=region_name)
+    return client
+
+
+# BatchImportFindings accepts at most 100 findings per request
+MAX_FINDINGS_PER_BATCH = int(os.getenv("MAX_FINDINGS_PER_BATCH", 100))
+MAX_BATCH_SIZE_BYTES = int(os.getenv("MAX_BATCH_SIZE_BYTES", 4 * 1024 * 1024))
+MAX_IMPORT_WORKERS = int(os.getenv("MAX_IMPORT_WORKERS", 4))
+TIMESTAMP_BATCH_SIZE = 1000
+FAILED_FINDINGS_MAX_RETRIES = int(os.getenv("FAILED_FINDINGS_MAX_RETRIES", 2))
+THROTTLING_ERROR_CODES = frozenset(("ThrottlingException", "TooManyRequestsException", "LimitExceededException"))
+# BatchImportFindings calls failing with a BotoCoreError are attempted IMPORT_MAX_ATTEMPTS times waiting at most
+# IMPORT_MAX_DELAY seconds between the attempts
+IMPORT_MAX_ATTEMPTS = 3
+IMPORT_MAX_DELAY = 10
+# error code of the findings of a chunk whose request failed without a response, e.g. EndpointConnectionError
+CONNECTION_ERROR_CODE = "ConnectionError"
+# error code of the findings of a chunk whose import raised an unexpected exception
+UNEXPECTED_ERROR_CODE = "InternalError"
+RETRYABLE_ERROR_CODES = THROTTLING_ERROR_CODES | frozenset(("InternalException", "ServiceUnavailableException",
+                                                            CONNECTION_ERROR_CODE))
+circuit_breaker = CircuitBreaker(failure_threshold=int(os.getenv("CIRCUIT_BREAKER_FAILURE_THRESHOLD", 3)),
+                                 reset_timeout=int(os.getenv("CIRCUIT_BREAKER_RESET_TIMEOUT", 300)),
+                                 state_file=os.getenv("CIRCUIT_BREAKER_STATE_FILE"), logger=logger)
+# retries are not attempted when less than reserve_time seconds of the invocation would be left
+deadline = Deadline(reserve_time=10)
+
+
+def log_retry_stats(func_name, attempts, total_sleep):
+    if attempts > 1:
+        logger.info("%s Attempts: %d TotalSleepTime: %.1f" % (func_name, attempts, total_sleep))
+
 
 def get_lambda_account_id(context):
     lambda_account_id = context.invoked_function_arn.split(":")[4]
     return lambda_account_id
 
 
-def generate_id(search_name, finding_account_id, securityhub_region):
-    uid = uuid.uuid4()
-    #Todo uuid generated from fields: ResourceID, ResourceType , Severity, Compliance, Type, Title and AWS AccountId
+def generate_id(search_name, finding_account_id, securityhub_region, finding):
+    # id is derived from the finding content so that re imported findings update the existing ones
+    resource = finding["Resources"][0]
+    fields = [resource["Id"], resource["Type"], finding["Severity"]["Normalized"],
+              finding.get("Compliance", {}).get("Status"), finding["Types"], finding["Title"], finding_account_id]
+    uid = hashlib.sha256(json.dumps(fields).encode("utf-8")).hexdigest()
     fid = "sumologic:%s:%s:%s/finding/%s" % (securityhub_region, finding_account_id, search_name, uid)
     return fid
 
 
-def convert_to_utc(timestamp):
-    #Todo change to convert to RFC3339
-    try:
-        if not isinstance(timestamp, int):
-            timestamp = timestamp.replace(",", "")
-            ts = int(timestamp)
-        else:
-            ts = timestamp
-            timestamp = str(timestamp)
-        ts = ts/1000 if len(timestamp) >= 13 else ts  # converting to seconds
-        utcdate = datetime.utcfromtimestamp(ts).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
-    except Exception as e:
-        logger.error("Unable to convert %s Error %s" % (timestamp, e))
-        utcdate = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
-    return utcdate
+# 9999-12-31T23:59:59.999Z is the largest timestamp which can be represented in RFC3339
+MAX_EPOCH_MILLIS = 253402300799999
 
 
-def generate_findings(data, finding_account_id, securityhub_region):
-    #Todo remove externalid, change to security hub, add productarn,update sdk, chunking
-    all_findings = []
-    product_arn = get_product_arn(securityhub_region)
-    for row in data['Rows']:
-        row["finding_time"] = convert_to_utc(row["finding_time"])
-        finding_account_id = row.get("aws_account_id", finding_account_id)
-        finding = {
-            "SchemaVersion": "2018-10-08",
-            "RecordState": "ACTIVE",
-            "ProductArn": product_arn,
-            "Description": data.get("Description", ""),
-            "SourceUrl": data.get("SourceUrl", ""),
-            "GeneratorId": data["GeneratorID"],
-            "AwsAccountId": finding_account_id,
-            "Id": generate_id(data["GeneratorID"], finding_account_id, securityhub_region),
-            "Types": [data["Types"]],
-            "CreatedAt": row["finding_time"],
-            "UpdatedAt": row["finding_time"],
-            "FirstObservedAt": row["finding_time"],
-            "Resources": [{
+def to_epoch_millis(timestamp):
+    if isinstance(timestamp, float):
+        timestamp = int(timestamp)
+    elif not isinstance(timestamp, int):
+        timestamp = int(str(timestamp).replace(",", ""))
+    timestamp = timestamp if timestamp >= 10 ** 12 else timestamp * 1000  # converting to milliseconds
+    if not 0 <= timestamp <= MAX_EPOCH_MILLIS:
+        raise ValueError("timestamp %d is out of range" % timestamp)
+    return timestamp
+
+
+def format_epoch_millis(epoch_millis):
+    return "%s.%03dZ" % (datetime.utcfromtimestamp(epoch_millis // 1000).strftime('%Y-%m-%dT%H:%M:%S'),
+                         epoch_millis % 1000)
+
+
+def format_timestamps(epoch_millis):
+    # formats epoch milliseconds to RFC3339
+    if np is not None and epoch_millis:
+        return np.datetime_as_string(np.array(epoch_millis, dtype='datetime64[ms]'), unit='ms', timezone='UTC').tolist()
+    return [format_epoch_millis(ts) for ts in epoch_millis]
+
+
+def convert_timestamps(timestamps):
+    # converts epoch timestamps(seconds or milliseconds) to RFC3339, invalid ones are returned as None
+    epoch_millis, invalid_indexes = [], []
+    for idx, timestamp in enumerate(timestamps):
+        try:
+            epoch_millis.append(to_epoch_millis(timestamp))
+        except (ValueError, TypeError) as e:
+            logger.error("Unable to convert %s Error %s" % (timestamp, e))
+            invalid_indexes.append(idx)
+    utc_dates = format_timestamps(epoch_millis)
+    for idx in invalid_indexes:
+        utc_dates.insert(idx, None)
+    return utc_dates, invalid_indexes
+
+
+def get_finding_template(data, securityhub_region):
+    # fields which are same for all the rows of a payload
+    template = {
+        "SchemaVersion": "2018-10-08",
+        "RecordState": "ACTIVE",
+        "ProductArn": get_product_arn(securityhub_region),
+        "Description": data.get("Description", ""),
+        "SourceUrl": data.get("SourceUrl", ""),
+        "GeneratorId": data["GeneratorID"],
+        "Types": [data["Types"]],
+        "Severity": {
+            "Normalized": int(data["Severity"])
+        }
+    }
+    if data.get("ComplianceStatus"):
+        template["Compliance"] = {"Status": data["ComplianceStatus"]}
+    return template
+
+
+def iter_findings(data, finding_account_id, securityhub_region):
+    # nested objects of the template are shared by all the findings so they should not be modified
+    template = get_finding_template(data, securityhub_region)
+    finding_ids = set()
+    duplicate_count = 0
+    rows = data['Rows']
+    for start in range(0, len(rows), TIMESTAMP_BATCH_SIZE):
+        batch = rows[start:start + TIMESTAMP_BATCH_SIZE]
+        # finding_time of the validated rows is already in epoch milliseconds
+        finding_times = format_timestamps([row["finding_time"] for row in batch])
+        for row, finding_time in zip(batch, finding_times):
+            account_id = row.get("aws_account_id", finding_account_id)
+            finding = dict(template)
+            finding["AwsAccountId"] = account_id
+            finding["CreatedAt"] = finding["UpdatedAt"] = finding["FirstObservedAt"] = finding_time
+            finding["Resources"] = [{
                 "Type": row["resource_type"],
                 "Id": row["resource_id"]
-            }],
-            "Severity": {
-                "Normalized": int(data["Severity"])
-            },
-            "Title": row["title"]
-        }
-        if data.get("ComplianceStatus"):
-            finding["Compliance"] = {"Status": data["ComplianceStatus"]}
-        all_findings.append(finding)
+            }]
+            finding["Title"] = row["title"]
+            finding["Id"] = generate_id(data["GeneratorID"], account_id, securityhub_region, finding)
+            if finding["Id"] in finding_ids:
+                duplicate_count += 1
+                continue
+            finding_ids.add(finding["Id"])
+            yield finding
+
+    if duplicate_count > 0:
+        logger.info("Dropped %d duplicate findings" % duplicate_count)
+
+
+def generate_findings(data, finding_account_id, securityhub_region):
+    return list(iter_findings(data, finding_account_id, securityhub_region))
+
 
-    return all_findings
+DATA_PARAMS = frozenset(("GeneratorID", "Types", "Rows", "Severity"))
+ROW_PARAMS = frozenset(("finding_time", "resource_type", "resource_id", "title"))
+WHITESPACE = re.compile(r'\s*')
+json_decoder = json.JSONDecoder()
+
+
+def iter_json_array(text):
+    # parses the elements of a json array one at a time instead of loading the whole array
+    idx = WHITESPACE.match(text, 0).end()
+    if text[idx:idx + 1] != "[":
+        raise ValueError("Rows should be a JSON array")
+    idx = WHITESPACE.match(text, idx + 1).end()
+    if text[idx:idx + 1] == "]":
+        return
+    while True:
+        obj, idx = json_decoder.raw_decode(text, idx)
+        yield obj
+        idx = WHITESPACE.match(text, idx).end()
+        if text[idx:idx + 1] == "]":
+            return
+        if text[idx:idx + 1] != ",":
+            raise ValueError("Rows is not a valid JSON array at position %d" % idx)
+        idx = WHITESPACE.match(text, idx + 1).end()
+
+
+def compile_row_validator(required_fields=ROW_PARAMS):
+    required_fields = frozenset(required_fields)
+
+    def validate_row(row):
+        # returns the reason for rejecting the row, finding_time is normalized to epoch milliseconds
+        if not isinstance(row, dict):
+            return "Row is not an object"
+        missing_fields = required_fields.difference(row)
+        if missing_fields:
+            return "%s Fields are missing" % ",".join(sorted(missing_fields))
+        try:
+            row["finding_time"] = to_epoch_millis(row["finding_time"])
+        except (ValueError, TypeError):
+            return "finding_time is invalid"
+        return None
+
+    return validate_row
+
+
+validate_row = compile_row_validator()
 
 
 def check_required_params(data):
-    data_params = set(("GeneratorID", "Types", "Rows", "Severity"))
-    row_params = set(("finding_time", "resource_type", "resource_id", "title"))
-    missing_fields = data_params - set(data.keys())
-    missing_fields = missing_fields | (row_params - set(data['Rows'][0].keys()))
+    missing_fields = DATA_PARAMS - set(data.keys())
     if missing_fields:
         raise KeyError("%s Fields are missing" % ",".join(missing_fields))
     severity = int(data.get("Severity"))
@@ -102,22 +247,37 @@ def check_required_params(data):
     if data.get("ComplianceStatus") and data["ComplianceStatus"] not in ("PASSED", "WARNING", "FAILED", "NOT_AVAILABLE"):
         raise ValueError("ComplianceStatus should be PASSED/WARNING/FAILED/NOT_AVAILABLE")
 
+    rows, rejected_rows = [], Counter()
+    all_rows = data['Rows'] if isinstance(data['Rows'], list) else iter_json_array(data['Rows'])
+    for row in all_rows:
+        reason = validate_row(row)
+        if reason:
+            rejected_rows[reason] += 1
+        else:
+            rows.append(row)
+    if not rows:
+        if rejected_rows:
+            raise KeyError(",".join(rejected_rows))
+        raise ValueError("Rows should not be empty")
+    data['Rows'] = rows
+    return rejected_rows
+
 
 def validate_params(data):
     try:
         data = json.loads(data)
-        data['Rows'] = json.loads(data.get('Rows', '[{}]'))
-        check_required_params(data)
+        rejected_rows = check_required_params(data)
     except ValueError as e:
-        return None, "Param Validation Error - %s" % str(e)
+        return None, None, "Param Validation Error - %s" % str(e)
     except KeyError as e:
-        return None, str(e)
+        return None, None, str(e)
     else:
-        return data, None
+        return data, rejected_rows, None
 
 
-def subscribe_to_sumo(securityhub_cli, securityhub_region):
+def subscribe_to_sumo(securityhub_region):
     product_arn = get_product_arn(securityhub_region)
+    securityhub_cli = get_client('securityhub', securityhub_region)
     try:
         resp = securityhub_cli.start_product_subscription(ProductArn=product_arn)
         subscription_arn = resp.get("ProductSubscriptionArn")
@@ -138,60 +298,358 @@ def process_response(resp):
 
     if failed_count > 0:
         err_msg = set()
-        for row in resp["Findings"]:
+        for row in get_failed_findings(resp):
             err_msg.add(row["ErrorMessage"])
         body += "ErrorMessage: %s" % ",".join(err_msg)
     return status_code, body
 
 
-@retry(ExceptionToCheck=(Exception,), max_retries=1, multiplier=2, logger=logger)
-def insert_findings(findings, securityhub_region):
-    logger.info("inserting findings %d" % len(findings))
+def chunk_findings(findings, max_count=MAX_FINDINGS_PER_BATCH, max_bytes=MAX_BATCH_SIZE_BYTES):
+    # splits findings into batches bounded both by count and by serialized size
+    chunk, chunk_size = [], 0
+    for finding in findings:
+        finding_size = len(json_dumps(finding))
+        if chunk and (len(chunk) >= max_count or chunk_size + finding_size > max_bytes):
+            yield chunk
+            chunk, chunk_size = [], 0
+        chunk.append(finding)
+        chunk_size += finding_size
+    if chunk:
+        yield chunk
+
+
+def failed_chunk_response(findings, error):
+    # converts a ClientError or a BotoCoreError into a BatchImportFindings like response so that it can be merged
+    # with other chunks, BotoCoreErrors have no response so they are reported as a retryable 503 and any other error
+    # as a 500
+    if isinstance(error, ClientError):
+        error_code = error.response['Error']['Code']
+        error_msg = error.response['Error']['Message']
+        status_code = error.response["ResponseMetadata"]["HTTPStatusCode"]
+    elif isinstance(error, BotoCoreError):
+        error_code = CONNECTION_ERROR_CODE
+        error_msg = "%s: %s" % (type(error).__name__, str(error))
+        status_code = 503
+    else:
+        error_code = UNEXPECTED_ERROR_CODE
+        error_msg = "%s: %s" % (type(error).__name__, str(error))
+        status_code = 500
+    if error_code == 'AccessDeniedException':
+        error_msg += " .Enable Sumo Logic as a Finding Provider"
+    return {
+        "FailedCount": len(findings),
+        "SuccessCount": 0,
+        "Findings": [{"Id": f["Id"], "ErrorCode": error_code, "ErrorMessage": error_msg} for f in findings],
+        "ResponseMetadata": {"HTTPStatusCode": status_code}
+    }
 
-    securityhub_cli = boto3.client('securityhub', region_name=securityhub_region)
+
+def get_failed_findings(resp):
+    # BatchImportFindings returns failed findings as FailedFindings, older sdk versions return them as Findings
+    return resp.get("FailedFindings", resp.get("Findings", []))
+
+
+def merge_responses(responses):
+    merged = {"FailedCount": 0, "SuccessCount": 0, "Findings": [], "ResponseMetadata": {"HTTPStatusCode": 200}}
+    for resp in responses:
+        merged["FailedCount"] += resp.get("FailedCount", 0)
+        merged["SuccessCount"] += resp.get("SuccessCount", 0)
+        merged["Findings"].extend(get_failed_findings(resp))
+        status_code = resp["ResponseMetadata"].get("HTTPStatusCode")
+        if status_code != 200 and merged["ResponseMetadata"]["HTTPStatusCode"] == 200:
+            merged["ResponseMetadata"]["HTTPStatusCode"] = status_code
+    return merged
+
+
+def send_findings(securityhub_cli, findings):
+    # ClientErrors are returned as a failed chunk, BotoCoreErrors(e.g. EndpointConnectionError) are raised to be retried
     try:
         resp = securityhub_cli.batch_import_findings(
             Findings=findings
         )
-        status_code, body = process_response(resp)
     except ClientError as e:
-        if e.response['Error']['Code'] == 'AccessDeniedException':
-            status_code = e.response["ResponseMetadata"]["HTTPStatusCode"]
-            body = e.response["Error"]["Message"] + " .Enable Sumo Logic as a Finding Provider"
-            logger.error(body)
-            # disabling automatic subscription to security hub
-            # subscribe_to_sumo(securityhub_cli, securityhub_region)
-            # resp = securityhub_cli.batch_import_findings(
-            #     Findings=findings
-            # )
-            # status_code, body = process_response(resp)
-        else:
-            status_code = e.response["ResponseMetadata"]["HTTPStatusCode"]
-            body = e.response["Error"]["Message"]
+        resp = log_failed_chunk(findings, e)
+        # disabling automatic subscription to security hub
+        # subscribe_to_sumo(securityhub_region)
+    return resp
+
+
+def log_failed_chunk(findings, error):
+    resp = failed_chunk_response(findings, error)
+    logger.error("Failed to import %d findings: %s" % (len(findings), resp["Findings"][0]["ErrorMessage"]))
+    return resp
+
+
+@retry(ExceptionToCheck=(BotoCoreError,), max_retries=IMPORT_MAX_ATTEMPTS, logger=logger,
+       handler_type=decorrelated_jitter_sleep, base_wait_time=1, max_delay=IMPORT_MAX_DELAY, deadline=deadline,
+       on_complete=log_retry_stats)
+def retry_send_findings(securityhub_cli, findings):
+    return send_findings(securityhub_cli, findings)
+
+
+@async_retry(ExceptionToCheck=(BotoCoreError,), max_retries=IMPORT_MAX_ATTEMPTS, logger=logger,
+             handler_type=decorrelated_jitter_sleep, base_wait_time=1, max_delay=IMPORT_MAX_DELAY, deadline=deadline,
+             on_complete=log_retry_stats)
+async def retry_send_findings_async(securityhub_cli, findings, executor=None):
+    # boto3 calls are blocking so they are made in the executor
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, send_findings, securityhub_cli, findings)
+
+
+def batch_import_findings(securityhub_cli, findings):
+    # a chunk which still fails to connect after the retries is returned as failed so that it is merged with the others
+    try:
+        return retry_send_findings(securityhub_cli, findings)
+    except BotoCoreError as e:
+        return log_failed_chunk(findings, e)
+
+
+async def batch_import_findings_async(securityhub_cli, findings, executor=None):
+    try:
+        return await retry_send_findings_async(securityhub_cli, findings, executor)
+    except BotoCoreError as e:
+        return log_failed_chunk(findings, e)
+
+
+def get_retry_ids(resp):
+    return set(f["Id"] for f in get_failed_findings(resp) if f.get("ErrorCode") in RETRYABLE_ERROR_CODES)
+
+
+def get_findings_retry_wait_time(delay_handler, retry_ids):
+    # returns the time to wait before retrying the failed findings or None if they should not be retried
+    if not retry_ids:
+        return None
+    wait_time = delay_handler()
+    remaining_time = deadline.remaining_time()
+    if remaining_time is not None and wait_time >= remaining_time:
+        logger.warning("Not retrying %d failed findings as only %.1f seconds are left" % (len(retry_ids), remaining_time))
+        return None
+    logger.warning("Retrying %d failed findings in %.1f seconds..." % (len(retry_ids), wait_time))
+    return wait_time
+
+
+def merge_retry_response(resp, retry_ids, retry_resp):
+    success_count = resp.get("SuccessCount", 0) + retry_resp.get("SuccessCount", 0)
+    # a failed retry of a few findings does not change the status of a chunk which was imported
+    if retry_resp["ResponseMetadata"].get("HTTPStatusCode") == 200 or success_count == 0:
+        response_metadata = retry_resp["ResponseMetadata"]
+    else:
+        response_metadata = resp["ResponseMetadata"]
+    return {
+        "FailedCount": resp.get("FailedCount", 0) - len(retry_ids) + retry_resp.get("FailedCount", 0),
+        "SuccessCount": success_count,
+        "Findings": [f for f in get_failed_findings(resp) if f["Id"] not in retry_ids] + get_failed_findings(retry_resp),
+        "ResponseMetadata": response_metadata
+    }
+
+
+def import_findings_chunk(securityhub_cli, findings):
+    # only the findings which failed with a retryable error code are submitted again
+    resp = batch_import_findings(securityhub_cli, findings)
+    delay_handler = decorrelated_jitter_sleep(1, max_wait_time=20)
+    attempts, total_sleep = 1, 0
+    for _ in range(FAILED_FINDINGS_MAX_RETRIES):
+        retry_ids = get_retry_ids(resp)
+        wait_time = get_findings_retry_wait_time(delay_handler, retry_ids)
+        if wait_time is None:
+            break
+        time.sleep(wait_time)
+        attempts += 1
+        total_sleep += wait_time
+        retry_resp = batch_import_findings(securityhub_cli, [f for f in findings if f["Id"] in retry_ids])
+        resp = merge_retry_response(resp, retry_ids, retry_resp)
+    log_retry_stats("import_findings_chunk", attempts, total_sleep)
+    return resp
+
+
+async def import_findings_chunk_async(securityhub_cli, findings, executor=None):
+    # asyncio counterpart of import_findings_chunk, waits with asyncio.sleep so that other chunks keep being imported
+    resp = await batch_import_findings_async(securityhub_cli, findings, executor)
+    delay_handler = decorrelated_jitter_sleep(1, max_wait_time=20)
+    attempts, total_sleep = 1, 0
+    for _ in range(FAILED_FINDINGS_MAX_RETRIES):
+        retry_ids = get_retry_ids(resp)
+        wait_time = get_findings_retry_wait_time(delay_handler, retry_ids)
+        if wait_time is None:
+            break
+        await asyncio.sleep(wait_time)
+        attempts += 1
+        total_sleep += wait_time
+        retry_resp = await batch_import_findings_async(securityhub_cli, [f for f in findings if f["Id"] in retry_ids],
+                                                       executor)
+        resp = merge_retry_response(resp, retry_ids, retry_resp)
+    log_retry_stats("import_findings_chunk_async", attempts, total_sleep)
+    return resp
+
+
+def get_chunk_response(chunk, result):
+    # the exception raised while importing a chunk is converted into a failed chunk so that the other chunks are merged
+    if isinstance(result, BaseException):
+        logger.error("Failed to import %d findings: %s" % (len(chunk), "".join(
+            traceback.format_exception(type(result), result, result.__traceback__))))
+        return failed_chunk_response(chunk, result)
+    return result
+
+
+def update_circuit_breaker(circuit_key, resp):
+    error_codes = set(f.get("ErrorCode") for f in get_failed_findings(resp))
+    status_code = resp["ResponseMetadata"].get("HTTPStatusCode")
+    if "AccessDeniedException" in error_codes:
+        circuit_breaker.record_failure(circuit_key, "AccessDeniedException .Enable Sumo Logic as a Finding Provider",
+                                       status_code, trip=True)
+    elif resp["SuccessCount"] == 0 and error_codes and error_codes <= THROTTLING_ERROR_CODES:
+        circuit_breaker.record_failure(circuit_key, ",".join(error_codes), status_code)
+    elif resp["SuccessCount"] > 0:
+        circuit_breaker.record_success(circuit_key)
+
+
+def insert_findings(findings, securityhub_region, circuit_key=None):
+    # findings can be any iterable, only a bounded number of chunks are held in memory at a time
+    securityhub_cli = get_client('securityhub', securityhub_region)
+    responses, pending = [], {}
+    # boto3 clients are thread safe so a single client is shared by all the workers
+    with ThreadPoolExecutor(max_workers=MAX_IMPORT_WORKERS) as executor:
+        for chunk in chunk_findings(findings):
+            if len(pending) >= 2 * MAX_IMPORT_WORKERS:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                responses.extend(get_chunk_response(pending.pop(future), future.exception() or future.result())
+                                 for future in done)
+            pending[executor.submit(import_findings_chunk, securityhub_cli, chunk)] = chunk
+        wait(pending)
+        responses.extend(get_chunk_response(chunk, future.exception() or future.result())
+                         for future, chunk in pending.items())
+    resp = merge_responses(responses)
+    if circuit_key:
+        update_circuit_breaker(circuit_key, resp)
+    logger.info("inserted findings %d" % (resp["SuccessCount"] + resp["FailedCount"]))
+    status_code, body = process_response(resp)
 
     logger.info(body)
     return status_code, body
 
 
+def add_rejected_rows(body, rejected_rows):
+    if rejected_rows:
+        body = "%s RejectedRows: %d (%s)" % (body.rstrip(), sum(rejected_rows.values()), ", ".join(
+            "%s: %d" % (reason, count) for reason, count in rejected_rows.items()))
+        logger.warning(body)
+    return body
+
+
+def check_circuit_breaker(circuit_key, securityhub_region, finding_account_id):
+    if circuit_breaker.allow_request(circuit_key):
+        return None, None
+    state = circuit_breaker.get_state(circuit_key)
+    body = "Skipping import for Region %s AccountId %s after %d failures: %s" % (
+        securityhub_region, finding_account_id, state["failures"], state["reason"])
+    logger.error(body)
+    return state["status_code"], body
+
+
 def lambda_handler(event, context):
+    deadline.update(context)
     lambda_account_id = get_lambda_account_id(context)
     lambda_region = os.getenv("AWS_REGION")
     logger.info("Invoking lambda_handler in Region %s AccountId %s" % (lambda_region, lambda_account_id))
     finding_account_id = os.getenv("AWS_ACCOUNT_ID", lambda_account_id)
     securityhub_region = os.getenv("REGION", lambda_region)
     # logger.info("event %s" % event)
-    data, err = validate_params(event['body'])
-    # data, err = validate_params(event)
-    if not err:
+    data, rejected_rows, err = validate_params(event['body'])
+    # data, rejected_rows, err = validate_params(event)
+    circuit_key = "%s:%s" % (securityhub_region, finding_account_id)
+    if "," in securityhub_region:
+        status_code = 400
+        body = "Bad Request: REGION %s has multiple regions which are only supported by async_lambda_handler" % (
+            securityhub_region)
+        logger.error(body)
+    elif err:
+        status_code = 400
+        body = "Bad Request: %s" % err
+    else:
+        status_code, body = check_circuit_breaker(circuit_key, securityhub_region, finding_account_id)
+    if status_code is None:
         try:
-            findings = generate_findings(data, finding_account_id, securityhub_region)
-            status_code, body = insert_findings(findings, securityhub_region)
+            findings = iter_findings(data, finding_account_id, securityhub_region)
+            status_code, body = insert_findings(findings, securityhub_region, circuit_key)
+            body = add_rejected_rows(body, rejected_rows)
         except Exception as e:
             status_code, body = 500, "Error: %s Traceback: %s" % (e, traceback.format_exc())
             logger.error(body)
-    else:
-        status_code = 400
-        body = "Bad Request: %s" % err
+    return {
+        "statusCode": status_code,
+        "body": body
+    }
+
+
+async def insert_findings_async(findings, securityhub_region, circuit_key=None, executor=None):
+    # findings are generated in the event loop while the previous chunks are being imported by the executor
+    securityhub_cli = get_client('securityhub', securityhub_region)
+    semaphore = asyncio.Semaphore(MAX_IMPORT_WORKERS)
+
+    async def import_chunk(chunk):
+        try:
+            return await import_findings_chunk_async(securityhub_cli, chunk, executor)
+        finally:
+            semaphore.release()
+
+    chunks, tasks = [], []
+    try:
+        for chunk in chunk_findings(findings):
+            await semaphore.acquire()
+            chunks.append(chunk)
+            tasks.append(asyncio.ensure_future(import_chunk(chunk)))
+    except BaseException:
+        # the scheduled chunks are finished before the error is raised
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    resp = merge_responses([get_chunk_response(chunk, result) for chunk, result in zip(chunks, results)])
+    if circuit_key:
+        update_circuit_breaker(circuit_key, resp)
+    logger.info("inserted findings %d in Region %s" % (resp["SuccessCount"] + resp["FailedCount"], securityhub_region))
+    status_code, body = process_response(resp)
+    logger.info(body)
+    return status_code, body
+
+
+async def import_to_region(data, rejected_rows, finding_account_id, securityhub_region, executor):
+    circuit_key = "%s:%s" % (securityhub_region, finding_account_id)
+    status_code, body = check_circuit_breaker(circuit_key, securityhub_region, finding_account_id)
+    if status_code is None:
+        try:
+            findings = iter_findings(data, finding_account_id, securityhub_region)
+            status_code, body = await insert_findings_async(findings, securityhub_region, circuit_key, executor)
+            body = add_rejected_rows(body, rejected_rows)
+        except Exception as e:
+            status_code, body = 500, "Error: %s Traceback: %s" % (e, traceback.format_exc())
+            logger.error(body)
+    return status_code, body
+
+
+async def process_event(event, context):
+    lambda_account_id = get_lambda_account_id(context)
+    lambda_region = os.getenv("AWS_REGION")
+    logger.info("Invoking async_lambda_handler in Region %s AccountId %s" % (lambda_region, lambda_account_id))
+    finding_account_id = os.getenv("AWS_ACCOUNT_ID", lambda_account_id)
+    # REGION can be a comma separated list of regions, findings are imported to all of them concurrently
+    securityhub_regions = [region.strip() for region in os.getenv("REGION", lambda_region).split(",")]
+    data, rejected_rows, err = validate_params(event['body'])
+    if err:
+        return 400, "Bad Request: %s" % err
+    with ThreadPoolExecutor(max_workers=MAX_IMPORT_WORKERS * len(securityhub_regions)) as executor:
+        results = await asyncio.gather(*[
+            import_to_region(data, rejected_rows, finding_account_id, region, executor)
+            for region in securityhub_regions])
+    if len(results) == 1:
+        return results[0]
+    status_code = next((code for code, _ in results if code != 200), 200)
+    body = " | ".join("Region %s %s" % (region, body.rstrip()) for region, (_, body) in zip(securityhub_regions, results))
+    return status_code, body
+
+
+def async_lambda_handler(event, context):
+    deadline.update(context)
+    status_code, body = asyncio.run(process_event(event, context))
     return {
         "statusCode": status_code,
         "body": body
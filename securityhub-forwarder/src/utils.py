@@ -1,6 +1,45 @@
+import os
+import json
 import time
+import asyncio
+import random
+import threading
 from functools import wraps
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+# all the serializers return compact utf-8 encoded bytes
+JSON_SERIALIZERS = {
+    "json": lambda data: json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+}
+if ujson is not None:
+    JSON_SERIALIZERS["ujson"] = lambda data: ujson.dumps(data, ensure_ascii=False,
+                                                         escape_forward_slashes=False).encode("utf-8")
+if orjson is not None:
+    JSON_SERIALIZERS["orjson"] = orjson.dumps
+
+
+def get_json_serializer(backend=None):
+    """Returns the serializer of backend, or of the fastest json library available if backend is not installed."""
+    if backend:
+        if backend in JSON_SERIALIZERS:
+            return JSON_SERIALIZERS[backend]
+        print("JSON_BACKEND %s is not available, using the fastest available one" % backend)
+    for backend in ("orjson", "ujson", "json"):
+        if backend in JSON_SERIALIZERS:
+            return JSON_SERIALIZERS[backend]
+
+
+json_dumps = get_json_serializer(os.getenv("JSON_BACKEND"))
+
 
 def fixed_sleep(fixed_wait_time):
     def handler():
@@ -32,34 +71,190 @@ def exponential_sleep(multiplier):
     return handler
 
 
+def decorrelated_jitter_sleep(base_wait_time, max_wait_time=60):
+    wait_time = base_wait_time
+
+    def handler():
+        nonlocal wait_time
+        wait_time = min(max_wait_time, random.uniform(base_wait_time, wait_time * 3))
+        return wait_time
+    return handler
+
+
+class Deadline(object):
+    """Tracks the remaining execution time of the current lambda invocation."""
+
+    def __init__(self, reserve_time=0):
+        # seconds kept aside for the work after the last retry
+        self.reserve_time = reserve_time
+        self.context = None
+
+    def update(self, context):
+        self.context = context
+
+    def remaining_time(self):
+        get_remaining_time = getattr(self.context, "get_remaining_time_in_millis", None)
+        if get_remaining_time is None:
+            return None
+        return get_remaining_time() / 1000.0 - self.reserve_time
+
+
+class CircuitBreaker(object):
+    """
+    Short circuits the calls for a key after repeated failures. The state is kept in memory so it survives warm
+    invocations and is optionally persisted to state_file. After reset_timeout seconds a single probe call is allowed.
+    """
+
+    def __init__(self, failure_threshold=3, reset_timeout=300, state_file=None, logger=None):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state_file = state_file
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.state = {}
+        if state_file and os.path.isfile(state_file):
+            try:
+                with open(state_file) as f:
+                    self.state = json.load(f)
+            except (IOError, OSError, ValueError) as e:
+                self._log("Failed to load circuit breaker state from %s: %s" % (state_file, e))
+                self.state = {}
+
+    def _log(self, msg):
+        if self.logger:
+            self.logger.error(msg)
+        else:
+            print(msg)
+
+    def _save(self):
+        # the state is still kept in memory if it can not be persisted
+        if self.state_file:
+            try:
+                with open(self.state_file, "w") as f:
+                    json.dump(self.state, f)
+            except (IOError, OSError) as e:
+                self._log("Failed to save circuit breaker state to %s: %s" % (self.state_file, e))
+
+    def get_state(self, key):
+        return self.state.get(key)
+
+    def allow_request(self, key):
+        with self.lock:
+            entry = self.state.get(key)
+            if not entry or entry["opened_at"] is None:
+                return True
+            if time.time() - entry["opened_at"] >= self.reset_timeout:
+                # half open, the timer is restarted so that only the current call probes the key
+                entry["opened_at"] = time.time()
+                self._save()
+                return True
+            return False
+
+    def record_success(self, key):
+        with self.lock:
+            if self.state.pop(key, None) is not None:
+                self._save()
+
+    def record_failure(self, key, reason, status_code, trip=False):
+        with self.lock:
+            entry = self.state.setdefault(key, {"failures": 0, "opened_at": None})
+            entry["failures"] += 1
+            entry["reason"] = reason
+            entry["status_code"] = status_code
+            if trip or entry["failures"] >= self.failure_threshold:
+                entry["opened_at"] = time.time()
+            self._save()
+
+
 def retry_if_exception_of_type(retryable_types):
     def _retry_if_exception_these_types(exception):
         return isinstance(exception, retryable_types)
     return _retry_if_exception_these_types
 
 
+def _get_wait_time(e, delay_handler, max_delay=None, deadline=None, logger=None):
+    # returns the time to wait before the next attempt or None if the deadline does not allow another attempt
+    wait_time = delay_handler()
+    if max_delay is not None:
+        wait_time = min(wait_time, max_delay)
+    remaining_time = deadline.remaining_time() if deadline else None
+    if remaining_time is not None and wait_time >= remaining_time:
+        msg = "%s, Not retrying as only %.1f seconds are left" % (str(e), remaining_time)
+        wait_time = None
+    else:
+        msg = "%s, Retrying in %.1f seconds..." % (str(e), wait_time)
+    if logger:
+        logger.warning(msg)
+    else:
+        print(msg)
+    return wait_time
+
+
 def retry(ExceptionToCheck=(Exception,), max_retries=4,
-          logger=None, handler_type=exponential_sleep, *hdlrargs, **hdlrkwargs):
+          logger=None, handler_type=exponential_sleep, *hdlrargs, max_delay=None, deadline=None, on_complete=None,
+          **hdlrkwargs):
+    """
+    max_delay caps every wait time, deadline stops retrying when the wait would exceed the remaining lambda time and
+    on_complete is called with the function name, number of attempts and total sleep time after every call
+    """
 
     def deco_retry(f):
 
         @wraps(f)
         def f_retry(*args, **kwargs):
             delay_handler = handler_type(*hdlrargs, **hdlrkwargs)
-            retries_left, wait_time = max_retries, delay_handler()
-            while retries_left > 1:
-                try:
-                    return f(*args, **kwargs)
-                except ExceptionToCheck as e:
-                    msg = "%s, Retrying in %d seconds..." % (str(e), wait_time)
-                    if logger:
-                        logger.warning(msg)
-                    else:
-                        print(msg)
-                    time.sleep(wait_time)
-                    retries_left -= 1
-                    wait_time = delay_handler()
-            return f(*args, **kwargs)
+            retries_left, attempts, total_sleep = max_retries, 0, 0
+            try:
+                while True:
+                    attempts += 1
+                    try:
+                        return f(*args, **kwargs)
+                    except ExceptionToCheck as e:
+                        if retries_left <= 1:
+                            raise
+                        wait_time = _get_wait_time(e, delay_handler, max_delay, deadline, logger)
+                        if wait_time is None:
+                            raise
+                        time.sleep(wait_time)
+                        total_sleep += wait_time
+                        retries_left -= 1
+            finally:
+                if on_complete:
+                    on_complete(f.__name__, attempts, total_sleep)
+
+        return f_retry
+
+    return deco_retry
+
+
+def async_retry(ExceptionToCheck=(Exception,), max_retries=4,
+                logger=None, handler_type=exponential_sleep, *hdlrargs, max_delay=None, deadline=None,
+                on_complete=None, **hdlrkwargs):
+    """asyncio counterpart of retry for coroutine functions, waits with asyncio.sleep instead of time.sleep"""
+
+    def deco_retry(f):
+
+        @wraps(f)
+        async def f_retry(*args, **kwargs):
+            delay_handler = handler_type(*hdlrargs, **hdlrkwargs)
+            retries_left, attempts, total_sleep = max_retries, 0, 0
+            try:
+                while True:
+                    attempts += 1
+                    try:
+                        return await f(*args, **kwargs)
+                    except ExceptionToCheck as e:
+                        if retries_left <= 1:
+                            raise
+                        wait_time = _get_wait_time(e, delay_handler, max_delay, deadline, logger)
+                        if wait_time is None:
+                            raise
+                        await asyncio.sleep(wait_time)
+                        total_sleep += wait_time
+                        retries_left -= 1
+            finally:
+                if on_complete:
+                    on_complete(f.__name__, attempts, total_sleep)
 
         return f_retry
 
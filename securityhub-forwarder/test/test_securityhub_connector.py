@@ -1,12 +1,22 @@
 import unittest
+import json
+import asyncio
+import tempfile
 import copy
 import sys
 import os
+from unittest.mock import patch
+
+from botocore.exceptions import ClientError, EndpointConnectionError
 
 sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
 
-from utils import retry, incrementing_sleep, fixed_sleep
-from securityhub_forwarder import lambda_handler
+from utils import retry, async_retry, incrementing_sleep, fixed_sleep, decorrelated_jitter_sleep, Deadline, \
+    CircuitBreaker, get_json_serializer, JSON_SERIALIZERS
+import securityhub_forwarder
+from securityhub_forwarder import lambda_handler, async_lambda_handler, chunk_findings, merge_responses, process_response, get_client, \
+    generate_findings, validate_params, convert_timestamps, iter_findings, \
+    import_findings_chunk, insert_findings, insert_findings_async, batch_import_findings, batch_import_findings_async
 
 del sys.path[0]
 
@@ -39,6 +49,38 @@ class TestLambda(unittest.TestCase):
         self.assertEqual(result['statusCode'], 400)
         self.assertTrue(result['body'] == 'Bad Request: Param Validation Error - Severity should be between 0 to 100', "%s body is not matching" % result['body'])
 
+    def test_async_send_success(self):
+        clients = {}
+
+        class SecurityHubClient:
+            def __init__(self):
+                self.calls = []
+
+            def batch_import_findings(self, Findings):
+                self.calls.append([f["Id"] for f in Findings])
+                failed = [{"Id": Findings[0]["Id"], "ErrorCode": "ThrottlingException", "ErrorMessage": "failed"}] \
+                    if len(self.calls) == 1 else []
+                return {"FailedCount": len(failed), "SuccessCount": len(Findings) - len(failed), "FailedFindings": failed,
+                        "ResponseMetadata": {"HTTPStatusCode": 200}}
+
+        def get_client(service, region):
+            return clients.setdefault(region, SecurityHubClient())
+
+        os.environ["REGION"] = "us-east-1,us-west-2"
+        try:
+            with patch.object(securityhub_forwarder, "get_client", get_client), \
+                    patch.object(securityhub_forwarder, "decorrelated_jitter_sleep", lambda *args, **kwargs: lambda: 0):
+                result = async_lambda_handler(self.event, self.context)
+        finally:
+            del os.environ["REGION"]
+        self.assertEqual(sorted(clients), ["us-east-1", "us-west-2"])
+        for client in clients.values():
+            self.assertEqual(len(client.calls), 2, "the throttled finding should be retried")
+            self.assertEqual(client.calls[1], client.calls[0][:1])
+        self.assertEqual(result['statusCode'], 200)
+        self.assertEqual(result['body'], 'Region us-east-1 FailedCount: 0 SuccessCount: 3 StatusCode: 200 | '
+                                         'Region us-west-2 FailedCount: 0 SuccessCount: 3 StatusCode: 200')
+
     def test_compliance_status_failure(self):
         pass
 
@@ -62,6 +104,210 @@ class TestLambda(unittest.TestCase):
         self.assertEqual(result['statusCode'], 400)
         self.assertTrue(result['body'] == "Bad Request: 'Types Fields are missing'", "%s body is not matching" % result['body'])
 
+    def test_chunk_findings(self):
+        findings = [{"Id": str(i), "Title": "x" * 100} for i in range(250)]
+        chunks = list(chunk_findings(findings, max_count=100, max_bytes=10 ** 6))
+        self.assertEqual([len(c) for c in chunks], [100, 100, 50])
+
+        chunks = list(chunk_findings(findings, max_count=100, max_bytes=1000))
+        self.assertTrue(all(len(c) <= 8 for c in chunks), "chunks should be bounded by serialized size")
+        self.assertEqual(sum(len(c) for c in chunks), 250)
+
+    def test_merge_responses(self):
+        responses = [
+            {"FailedCount": 0, "SuccessCount": 100, "Findings": [], "ResponseMetadata": {"HTTPStatusCode": 200}},
+            {"FailedCount": 1, "SuccessCount": 49, "Findings": [{"Id": "1", "ErrorCode": "InvalidInput", "ErrorMessage": "Invalid Title"}],
+             "ResponseMetadata": {"HTTPStatusCode": 200}}
+        ]
+        status_code, body = process_response(merge_responses(responses))
+        self.assertEqual(status_code, 200)
+        self.assertEqual(body, 'FailedCount: 1 SuccessCount: 149 StatusCode: 200 ErrorMessage: Invalid Title')
+
+    def test_partial_failure_retry(self):
+        class SecurityHubClient:
+            def __init__(self):
+                self.calls = []
+
+            def batch_import_findings(self, Findings):
+                self.calls.append([f["Id"] for f in Findings])
+                failed = [{"Id": f["Id"], "ErrorCode": "ThrottlingException" if f["Id"] == "2" else "InvalidInput",
+                           "ErrorMessage": "failed"} for f in Findings if f["Id"] in ("2", "3") and len(self.calls) == 1]
+                return {"FailedCount": len(failed), "SuccessCount": len(Findings) - len(failed), "FailedFindings": failed,
+                        "ResponseMetadata": {"HTTPStatusCode": 200}}
+
+        client = SecurityHubClient()
+        resp = import_findings_chunk(client, [{"Id": str(i)} for i in range(5)])
+        self.assertEqual(client.calls, [["0", "1", "2", "3", "4"], ["2"]], "only throttled findings should be retried")
+        self.assertEqual((resp["SuccessCount"], resp["FailedCount"]), (4, 1))
+        self.assertEqual([f["Id"] for f in resp["Findings"]], ["3"])
+
+    def test_throttled_retry_keeps_status(self):
+        class SecurityHubClient:
+            def __init__(self):
+                self.calls = 0
+
+            def batch_import_findings(self, Findings):
+                self.calls += 1
+                if self.calls > 1:
+                    raise ClientError({"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"},
+                                       "ResponseMetadata": {"HTTPStatusCode": 400}}, "BatchImportFindings")
+                failed = [{"Id": "0", "ErrorCode": "ThrottlingException", "ErrorMessage": "failed"}]
+                return {"FailedCount": 1, "SuccessCount": len(Findings) - 1, "FailedFindings": failed,
+                        "ResponseMetadata": {"HTTPStatusCode": 200}}
+
+        with patch.object(securityhub_forwarder, "FAILED_FINDINGS_MAX_RETRIES", 1), \
+                patch.object(securityhub_forwarder.time, "sleep"):
+            resp = import_findings_chunk(SecurityHubClient(), [{"Id": str(i)} for i in range(100)])
+        self.assertEqual((resp["SuccessCount"], resp["FailedCount"]), (99, 1))
+        self.assertEqual(resp["ResponseMetadata"]["HTTPStatusCode"], 200)
+
+    def test_connection_error_chunk(self):
+        class SecurityHubClient:
+            def __init__(self):
+                self.calls = []
+
+            def batch_import_findings(self, Findings):
+                self.calls.append(len(Findings))
+                if len(self.calls) == 2:
+                    raise EndpointConnectionError(endpoint_url="https://securityhub.us-east-1.amazonaws.com")
+                return {"FailedCount": 0, "SuccessCount": len(Findings), "FailedFindings": [],
+                        "ResponseMetadata": {"HTTPStatusCode": 200}}
+
+        client = SecurityHubClient()
+        findings = [{"Id": str(i)} for i in range(300)]
+        with patch.object(securityhub_forwarder, "get_client", lambda service, region: client), \
+                patch.object(securityhub_forwarder, "MAX_IMPORT_WORKERS", 1), \
+                patch.object(securityhub_forwarder, "FAILED_FINDINGS_MAX_RETRIES", 1), \
+                patch.object(securityhub_forwarder.time, "sleep"):
+            status_code, body = insert_findings(findings, "us-east-1")
+        self.assertEqual(client.calls, [100, 100, 100, 100], "the chunk which failed to connect should be retried")
+        self.assertEqual((status_code, body.strip()), (200, "FailedCount: 0 SuccessCount: 300 StatusCode: 200"))
+
+    def test_connection_error_retry(self):
+        class SecurityHubClient:
+            def __init__(self, failures):
+                self.failures, self.calls = failures, 0
+
+            def batch_import_findings(self, Findings):
+                self.calls += 1
+                if self.calls <= self.failures:
+                    raise EndpointConnectionError(endpoint_url="https://securityhub.us-east-1.amazonaws.com")
+                return {"FailedCount": 0, "SuccessCount": len(Findings), "FailedFindings": [],
+                        "ResponseMetadata": {"HTTPStatusCode": 200}}
+
+        async def no_sleep(delay):
+            pass
+
+        findings = [{"Id": str(i)} for i in range(5)]
+        with patch.object(securityhub_forwarder.time, "sleep"), patch.object(asyncio, "sleep", no_sleep):
+            client = SecurityHubClient(failures=2)
+            self.assertEqual(batch_import_findings(client, findings)["SuccessCount"], 5)
+            self.assertEqual(client.calls, 3)
+
+            client = SecurityHubClient(failures=3)
+            resp = batch_import_findings(client, findings)
+            self.assertEqual(client.calls, securityhub_forwarder.IMPORT_MAX_ATTEMPTS)
+            self.assertEqual((resp["FailedCount"], resp["ResponseMetadata"]["HTTPStatusCode"]), (5, 503))
+            self.assertEqual(set(f["ErrorCode"] for f in resp["Findings"]), {"ConnectionError"})
+
+            client = SecurityHubClient(failures=2)
+            self.assertEqual(asyncio.run(batch_import_findings_async(client, findings))["SuccessCount"], 5)
+            self.assertEqual(client.calls, 3)
+
+    def test_failed_chunk_task(self):
+        class SecurityHubClient:
+            def __init__(self):
+                self.calls = 0
+
+            def batch_import_findings(self, Findings):
+                self.calls += 1
+                if self.calls == 2:
+                    raise RuntimeError("unexpected error")
+                return {"FailedCount": 0, "SuccessCount": len(Findings), "FailedFindings": [],
+                        "ResponseMetadata": {"HTTPStatusCode": 200}}
+
+        findings = [{"Id": str(i)} for i in range(300)]
+        for insert in (insert_findings, lambda *args: asyncio.run(insert_findings_async(*args))):
+            client = SecurityHubClient()
+            with patch.object(securityhub_forwarder, "get_client", lambda service, region: client), \
+                    patch.object(securityhub_forwarder, "MAX_IMPORT_WORKERS", 1):
+                status_code, body = insert(findings, "us-east-1")
+            self.assertEqual(status_code, 500)
+            self.assertTrue(body.startswith("FailedCount: 100 SuccessCount: 200 StatusCode: 500"), body)
+
+    def test_multiple_regions_in_lambda_handler(self):
+        os.environ["REGION"] = "us-east-1,us-west-2"
+        try:
+            result = lambda_handler(self.event, self.context)
+        finally:
+            del os.environ["REGION"]
+        self.assertEqual(result['statusCode'], 400)
+        self.assertIn("async_lambda_handler", result['body'])
+
+    def test_json_serializer(self):
+        self.assertIs(get_json_serializer("json"), JSON_SERIALIZERS["json"])
+        dumps = get_json_serializer("missingbackend")
+        self.assertIn(dumps, JSON_SERIALIZERS.values())
+        self.assertEqual(json.loads(dumps({"Id": "caf\u00e9"})), {"Id": "caf\u00e9"})
+
+    def test_client_cache(self):
+        client = get_client('securityhub', 'us-east-1')
+        self.assertIs(client, get_client('securityhub', 'us-east-1'))
+        self.assertIsNot(client, get_client('securityhub', 'us-west-2'))
+
+    def test_deterministic_finding_ids(self):
+        data, rejected_rows, err = validate_params(self.event['body'])
+        data['Rows'].append(dict(data['Rows'][0], finding_time="1545042500000"))
+        findings = generate_findings(data, "956882708938", "us-east-1")
+        self.assertEqual(len(findings), 3, "rows differing only in finding_time should be deduplicated")
+
+        data, rejected_rows, err = validate_params(self.event['body'])
+        self.assertEqual([f["Id"] for f in findings],
+                         [f["Id"] for f in generate_findings(data, "956882708938", "us-east-1")])
+
+    def test_iter_findings(self):
+        data, rejected_rows, err = validate_params(self.event['body'])
+        data['Rows'][0]["aws_account_id"] = "068873283051"
+        findings = iter_findings(data, "956882708938", "us-east-1")
+        self.assertFalse(isinstance(findings, list), "findings should be generated lazily")
+        self.assertEqual([f["AwsAccountId"] for f in findings], ["068873283051", "956882708938", "956882708938"])
+
+    def test_seconds_finding_time_before_2001(self):
+        payload = json.loads(self.event['body'])
+        rows = payload['Rows'] if isinstance(payload['Rows'], list) else json.loads(payload['Rows'])
+        payload['Rows'] = [dict(rows[0], finding_time="946684800")]
+        data, rejected_rows, err = validate_params(json.dumps(payload))
+        self.assertIsNone(err)
+        for numpy in (securityhub_forwarder.np, None):
+            with patch.object(securityhub_forwarder, "np", numpy):
+                findings = generate_findings(data, "956882708938", "us-east-1")
+            self.assertEqual([f["CreatedAt"] for f in findings], ["2000-01-01T00:00:00.000Z"])
+
+    def test_convert_timestamps(self):
+        timestamps = ["1545042427000", 1545042427, "1,545,042,427,123", "invalid", None]
+        expected = ["2018-12-17T10:27:07.000Z", "2018-12-17T10:27:07.000Z", "2018-12-17T10:27:07.123Z", None, None]
+        self.assertEqual(convert_timestamps(timestamps), (expected, [3, 4]))
+
+        np = securityhub_forwarder.np
+        securityhub_forwarder.np = None
+        try:
+            self.assertEqual(convert_timestamps(timestamps), (expected, [3, 4]))
+        finally:
+            securityhub_forwarder.np = np
+
+    def test_row_validation(self):
+        event = copy.copy(self.event)
+        event['body'] = event['body'].replace('\\"finding_time\\":\\"1545042427000\\",', '', 1)
+        data, rejected_rows, err = validate_params(event['body'])
+        self.assertIsNone(err)
+        self.assertEqual(len(data['Rows']), 2)
+        self.assertEqual(dict(rejected_rows), {"finding_time Fields are missing": 1})
+
+        event['body'] = event['body'].replace('\\"finding_time\\":\\"1545042427000\\",', '')
+        result = lambda_handler(event, self.context)
+        self.assertEqual(result['statusCode'], 400)
+        self.assertEqual(result['body'], "Bad Request: 'finding_time Fields are missing'")
+
     def test_retry(self):
         class Logger:
             def __init__(self):
@@ -100,6 +346,71 @@ class TestLambda(unittest.TestCase):
             func()
         self.assertTrue(len(logger3.messages) == 1, "incremental_sleep(2) with 2 retries should contain 1 message")
 
+    def test_retry_deadline_and_stats(self):
+        stats = []
+
+        class Context:
+            def get_remaining_time_in_millis(self):
+                return 3000
+
+        deadline = Deadline(reserve_time=2)
+        deadline.update(Context())
+
+        @retry(ExceptionToCheck=(KeyError,), max_retries=3, handler_type=fixed_sleep, fixed_wait_time=2,
+               deadline=deadline, on_complete=lambda *args: stats.append(args))
+        def func():
+            return {}["key"]
+
+        with self.assertRaises(KeyError):
+            func()
+        self.assertEqual(stats, [("func", 1, 0)], "should not retry when the wait exceeds the remaining time")
+
+        @retry(ExceptionToCheck=(KeyError,), max_retries=3, handler_type=decorrelated_jitter_sleep, base_wait_time=1,
+               max_delay=0.1, on_complete=lambda *args: stats.append(args))
+        def func():
+            return {}["key"]
+
+        with self.assertRaises(KeyError):
+            func()
+        self.assertEqual(stats[1][:2], ("func", 3))
+        self.assertTrue(stats[1][2] <= 0.2, "wait time should be capped by max_delay")
+
+    def test_async_retry(self):
+        stats = []
+
+        @async_retry(ExceptionToCheck=(KeyError,), max_retries=3, handler_type=fixed_sleep, fixed_wait_time=0.1,
+                     on_complete=lambda *args: stats.append(args))
+        async def func():
+            return {}["key"]
+
+        with self.assertRaises(KeyError):
+            asyncio.run(func())
+        self.assertEqual(stats[0][:2], ("func", 3))
+
+    def test_circuit_breaker(self):
+        state_file = os.path.join(tempfile.mkdtemp(), "circuit_breaker.json")
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60, state_file=state_file)
+        breaker.record_failure("us-east-1:956882708938", "ThrottlingException", 429)
+        self.assertTrue(breaker.allow_request("us-east-1:956882708938"))
+        breaker.record_failure("us-east-1:956882708938", "ThrottlingException", 429)
+        self.assertFalse(breaker.allow_request("us-east-1:956882708938"))
+        breaker.record_failure("us-west-2:956882708938", "AccessDeniedException", 403, trip=True)
+        self.assertFalse(breaker.allow_request("us-west-2:956882708938"))
+
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0, state_file=state_file)
+        self.assertEqual(breaker.get_state("us-west-2:956882708938")["status_code"], 403)
+        self.assertTrue(breaker.allow_request("us-west-2:956882708938"), "should allow a probe after reset_timeout")
+        breaker.record_success("us-west-2:956882708938")
+        self.assertIsNone(breaker.get_state("us-west-2:956882708938"))
+
+    def test_circuit_breaker_unwritable_state_file(self):
+        state_file = os.path.join(tempfile.mkdtemp(), "missing", "circuit_breaker.json")
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0, state_file=state_file)
+        breaker.record_failure("us-east-1:956882708938", "ThrottlingException", 429)
+        self.assertTrue(breaker.allow_request("us-east-1:956882708938"), "state should be kept in memory")
+        self.assertEqual(breaker.get_state("us-east-1:956882708938")["failures"], 1)
+
+
 if __name__ == '__main__':
 
     unittest.main()
@@ -4,7 +4,7 @@ import six
 import re
 import json
 import requests
-from sumologic import SumoLogic
+from sumologic import SumoLogic, get_deployment_endpoint
 import tempfile
 from datetime import datetime
 import time
@@ -144,12 +144,7 @@ class SumoResource(object):
 
     @property
     def api_endpoint(self):
-        if self.deployment == "us1":
-            return "https://api.sumologic.com/api"
-        elif self.deployment in ["ca", "au", "de", "eu", "jp", "us2", "fed", "in"]:
-            return "https://api.%s.sumologic.com/api" % self.deployment
-        else:
-            return 'https://%s-api.sumologic.net/api' % self.deployment
+        return get_deployment_endpoint(self.deployment)
 
     def is_enterprise_or_trial_account(self):
         to_time = int(time.time()) * 1000
@@ -1,7 +1,13 @@
+import hashlib
 import json
+import os
+import re
 import requests
+import threading
 import time
 import random
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 try:
     import cookielib
@@ -9,17 +15,91 @@ except ImportError:
     import http.cookiejar as cookielib
 
 DEFAULT_VERSION = 'v1'
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = 10
+MAX_RETRIES = 5
+BACKOFF_FACTOR = 1
+RETRY_STATUS_CODES = (429, 503)
+RETRY_METHODS = frozenset(['GET', 'POST', 'PUT', 'DELETE', 'HEAD', 'OPTIONS'])
+DEFAULT_ENDPOINT = 'https://api.sumologic.com/api'
+DEPLOYMENTS = ["ca", "au", "de", "eu", "jp", "us2", "fed", "in"]
+ENDPOINT_CACHE_TTL = 24 * 60 * 60
+
+# discovered endpoints by access id, shared by all the clients in the container
+_endpoint_cache = {}
+_endpoint_cache_lock = threading.Lock()
+# session affinity cookies by access id(and cookie file), shared by all the clients of an account
+_cookie_jars = {}
+_cookie_jars_lock = threading.Lock()
+
+
+def get_cookie_jar(accessId, cookieFile=None):
+    """
+    Returns the cookie jar shared by the clients of the account. Cookies are kept in memory unless a cookieFile is
+    given, in which case they are loaded from it if it exists and are only written by SumoLogic.save_cookies.
+    """
+    key = (accessId, cookieFile)
+    with _cookie_jars_lock:
+        if key not in _cookie_jars:
+            if cookieFile is None:
+                cj = requests.cookies.RequestsCookieJar()
+            else:
+                cj = cookielib.LWPCookieJar(cookieFile)
+                if os.path.isfile(cookieFile):
+                    try:
+                        cj.load(ignore_discard=True)
+                    except (cookielib.LoadError, IOError, OSError) as e:
+                        # the file is overwritten by the next save_cookies
+                        print("Failed to load cookies %s, starting with no cookies: %s" % (cookieFile, e))
+                        cj = cookielib.LWPCookieJar(cookieFile)
+            _cookie_jars[key] = cj
+        return _cookie_jars[key]
+
+
+def get_deployment_endpoint(deployment):
+    if deployment == "us1":
+        return DEFAULT_ENDPOINT
+    elif deployment in DEPLOYMENTS:
+        return "https://api.%s.sumologic.com/api" % deployment
+    else:
+        return 'https://%s-api.sumologic.net/api' % deployment
+
+
+def get_retry(max_retries=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR):
+    """
+    Rate limited (429) and unavailable (503) requests are not processed by the server so they are retried for every
+    method, the Retry-After header is honoured and exponential backoff is used otherwise. The last response is returned
+    once the retries are exhausted so that the caller raises the same HTTPError as before.
+    """
+    kwargs = dict(total=max_retries, connect=max_retries, read=0, backoff_factor=backoff_factor,
+                  status_forcelist=RETRY_STATUS_CODES, respect_retry_after_header=True, raise_on_status=False)
+    try:
+        return Retry(allowed_methods=RETRY_METHODS, **kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=RETRY_METHODS, **kwargs)
 
 
 class SumoLogic(object):
 
-    def __init__(self, accessId, accessKey, endpoint=None, cookieFile='cookies.txt'):
+    def __init__(self, accessId, accessKey, endpoint=None, cookieFile=None, pool_connections=POOL_CONNECTIONS,
+                 pool_maxsize=POOL_MAXSIZE, max_retries=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR, deployment=None,
+                 endpoint_cache_file=None, endpoint_cache_ttl=ENDPOINT_CACHE_TTL):
         self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                              max_retries=get_retry(max_retries, backoff_factor))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.request_stats = {}
+        self._stats_lock = threading.Lock()
         self.session.auth = (accessId, accessKey)
         self.session.headers = {'content-type': 'application/json', 'accept': 'application/json'}
-        cj = cookielib.FileCookieJar(cookieFile)
-        self.session.cookies = cj
-        if endpoint is None:
+        self.session.cookies = get_cookie_jar(accessId, cookieFile)
+        self.endpoint_cache_file = endpoint_cache_file
+        self.endpoint_cache_ttl = endpoint_cache_ttl
+        if endpoint is None and deployment:
+            self.endpoint = get_deployment_endpoint(deployment)
+        elif endpoint is None:
             self.endpoint = self._get_endpoint()
         else:
             self.endpoint = endpoint
@@ -36,47 +116,104 @@ class SumoLogic(object):
         unhelpful message is shown 'Full authentication is required to access this resource'
         This method makes a request to the default REST endpoint and resolves the 401 to learn
         the right endpoint
+        The resolved endpoint is cached by access id in memory and, if endpoint_cache_file is set, in that file
+        for endpoint_cache_ttl seconds so that the request is made at most once per container.
+        A throttled (429) or failed (5xx) probe is not cached since it may not have been redirected
         """
-        self.endpoint = 'https://api.sumologic.com/api'
-        self.response = self.session.get('https://api.sumologic.com/api/v1/collectors')  # Dummy call to get endpoint
+        access_id = self.session.auth[0]
+        endpoint = self._get_cached_endpoint(access_id)
+        if endpoint:
+            return endpoint
+        self.endpoint = DEFAULT_ENDPOINT
+        self.response = self.session.get(DEFAULT_ENDPOINT + '/v1/collectors')  # Dummy call to get endpoint
         endpoint = self.response.url.replace('/v1/collectors', '')  # dirty hack to sanitise URI and retain domain
         print("SDK Endpoint", endpoint)
+        if self.response.status_code != 429 and self.response.status_code < 500:
+            self._cache_endpoint(access_id, endpoint)
         return endpoint
 
+    def _get_cached_endpoint(self, access_id):
+        now = time.time()
+        with _endpoint_cache_lock:
+            if access_id in _endpoint_cache and _endpoint_cache[access_id][1] > now:
+                return _endpoint_cache[access_id][0]
+            if self.endpoint_cache_file:
+                entry = self._read_endpoint_cache_file().get(self._endpoint_cache_key(access_id))
+                if entry and entry[1] > now:
+                    _endpoint_cache[access_id] = tuple(entry)
+                    return entry[0]
+        return None
+
+    def _cache_endpoint(self, access_id, endpoint):
+        entry = (endpoint, time.time() + self.endpoint_cache_ttl)
+        with _endpoint_cache_lock:
+            _endpoint_cache[access_id] = entry
+            if self.endpoint_cache_file:
+                entries = self._read_endpoint_cache_file()
+                entries[self._endpoint_cache_key(access_id)] = entry
+                try:
+                    with open(self.endpoint_cache_file, 'w') as f:
+                        json.dump(entries, f)
+                except (IOError, OSError) as e:
+                    print("Failed to write endpoint cache %s: %s" % (self.endpoint_cache_file, e))
+
+    def _read_endpoint_cache_file(self):
+        if not os.path.isfile(self.endpoint_cache_file):
+            return {}
+        try:
+            with open(self.endpoint_cache_file) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            print("Failed to read endpoint cache %s: %s" % (self.endpoint_cache_file, e))
+            return {}
+
+    @staticmethod
+    def _endpoint_cache_key(access_id):
+        # the access id is not written to the file as is
+        return hashlib.sha256(access_id.encode('utf-8')).hexdigest()
+
+    def save_cookies(self):
+        # only cookie jars created with a cookieFile can be saved
+        if isinstance(self.session.cookies, cookielib.FileCookieJar):
+            self.session.cookies.save(ignore_discard=True)
+
     def get_versioned_endpoint(self, version):
         return self.endpoint + '/%s' % version
 
-    def delete(self, method, params=None, version=DEFAULT_VERSION):
+    def _request(self, http_method, method, version=DEFAULT_VERSION, **kwargs):
         endpoint = self.get_versioned_endpoint(version)
-        r = self.session.delete(endpoint + method, params=params)
+        start = time.time()
+        r = self.session.request(http_method, endpoint + method, **kwargs)
+        self._record_timing(http_method, version, method, time.time() - start, r)
         if 400 <= r.status_code < 600:
             r.reason = r.text
         r.raise_for_status()
         return r
 
+    def _record_timing(self, http_method, version, method, elapsed, response):
+        # ids are replaced so that all the calls of an api are aggregated together
+        path = re.sub(r'/[^/?]*\d[^/?]*', '/{id}', method.split('?')[0])
+        retries = getattr(response.raw, 'retries', None)
+        retry_count = len(retries.history) if retries is not None else 0
+        key = '%s /%s%s' % (http_method, version, path)
+        with self._stats_lock:
+            stats = self.request_stats.setdefault(key, {'count': 0, 'retries': 0, 'total_time': 0.0, 'max_time': 0.0})
+            stats['count'] += 1
+            stats['retries'] += retry_count
+            stats['total_time'] += elapsed
+            stats['max_time'] = max(stats['max_time'], elapsed)
+
+    def delete(self, method, params=None, version=DEFAULT_VERSION):
+        return self._request('DELETE', method, version, params=params)
+
     def get(self, method, params=None, version=DEFAULT_VERSION):
-        endpoint = self.get_versioned_endpoint(version)
-        r = self.session.get(endpoint + method, params=params)
-        if 400 <= r.status_code < 600:
-            r.reason = r.text
-        r.raise_for_status()
-        return r
+        return self._request('GET', method, version, params=params)
 
     def post(self, method, params, headers=None, version=DEFAULT_VERSION):
-        endpoint = self.get_versioned_endpoint(version)
-        r = self.session.post(endpoint + method, data=json.dumps(params), headers=headers)
-        if 400 <= r.status_code < 600:
-            r.reason = r.text
-        r.raise_for_status()
-        return r
+        return self._request('POST', method, version, data=json.dumps(params), headers=headers)
 
     def put(self, method, params, headers=None, version=DEFAULT_VERSION):
-        endpoint = self.get_versioned_endpoint(version)
-        r = self.session.put(endpoint + method, data=json.dumps(params), headers=headers)
-        if 400 <= r.status_code < 600:
-            r.reason = r.text
-        r.raise_for_status()
-        return r
+        return self._request('PUT', method, version, data=json.dumps(params), headers=headers)
 
     def search(self, query, fromTime=None, toTime=None, timeZone='UTC'):
         params = {'q': query, 'from': fromTime, 'to': toTime, 'tz': timeZone}
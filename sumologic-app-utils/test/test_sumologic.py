@@ -0,0 +1,211 @@
+import unittest
+import json
+import sys
+import os
+import threading
+import time
+import shutil
+import tempfile
+from unittest.mock import patch
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer as ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import sumologic
+from sumologic import SumoLogic
+
+del sys.path[0]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers with the queued (status, headers, body) responses of the server and 200 once they are used up."""
+    protocol_version = 'HTTP/1.1'
+
+    def handle_request(self):
+        length = int(self.headers.get('content-length') or 0)
+        body = self.rfile.read(length) if length else b''
+        self.server.requests.append((self.command, self.path, self.headers.get('Cookie'), body))
+        status, headers, body = self.server.responses.pop(0) if self.server.responses else (200, {}, b'{}')
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+    def log_message(self, *args):
+        pass
+
+
+class TestSumoLogic(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.daemon_threads = True
+        self.server.requests, self.server.responses = [], []
+        threading.Thread(target=self.server.serve_forever).start()
+        self.endpoint = 'http://127.0.0.1:%d/api' % self.server.server_address[1]
+        sumologic._endpoint_cache.clear()
+        sumologic._cookie_jars.clear()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_retry_after(self):
+        self.server.responses = [(429, {'Retry-After': '1'}, b'{"code":"rate.limit.exceeded"}')]
+        client = SumoLogic('accessId', 'accessKey', self.endpoint)
+        start = time.time()
+        r = client.post('/collectors', {'collector': {'name': 'test'}})
+        self.assertEqual(r.status_code, 200)
+        self.assertGreaterEqual(time.time() - start, 1, "Retry-After should be honoured")
+        self.assertEqual([(method, path) for method, path, _, _ in self.server.requests],
+                         [('POST', '/api/v1/collectors')] * 2)
+        self.assertEqual(json.loads(self.server.requests[1][3]), {'collector': {'name': 'test'}})
+
+    def test_retries_exhausted(self):
+        self.server.responses = [(503, {}, b'{"code":"unavailable"}')] * 3
+        client = SumoLogic('accessId', 'accessKey', self.endpoint, max_retries=2, backoff_factor=0)
+        with self.assertRaises(requests.exceptions.HTTPError) as cm:
+            client.get('/collectors')
+        self.assertEqual(cm.exception.response.status_code, 503)
+        self.assertIn('{"code":"unavailable"}', str(cm.exception))
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_client_errors_are_not_retried(self):
+        self.server.responses = [(404, {}, b'{"code":"not.found"}')]
+        client = SumoLogic('accessId', 'accessKey', self.endpoint, backoff_factor=0)
+        with self.assertRaises(requests.exceptions.HTTPError) as cm:
+            client.delete('/collectors/000000000ABC123')
+        self.assertEqual(cm.exception.response.reason, '{"code":"not.found"}')
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_request_stats(self):
+        self.server.responses = [(429, {'Retry-After': '0'}, b'{}')]
+        client = SumoLogic('accessId', 'accessKey', self.endpoint, backoff_factor=0)
+        client.get('/collectors/000000000ABC123')
+        client.get('/collectors/000000000DEF456/sources', params={'limit': 10})
+        client.put('/collectors/000000000DEF456', {'collector': {}})
+        client.get('/collectors/000000000DEF456')
+        self.assertEqual(sorted(client.request_stats), ['GET /v1/collectors/{id}', 'GET /v1/collectors/{id}/sources',
+                                                        'PUT /v1/collectors/{id}'])
+        stats = client.request_stats['GET /v1/collectors/{id}']
+        self.assertEqual((stats['count'], stats['retries']), (2, 1))
+        self.assertGreaterEqual(stats['total_time'], stats['max_time'])
+
+    def redirect_probe(self):
+        # the default endpoint redirects to the deployment of the access id, which then rejects the dummy call
+        self.server.responses.extend([(301, {'Location': self.endpoint.replace('/api', '/au/api') + '/v1/collectors'}, b''),
+                                      (401, {}, b'{"code":"unauthorized"}')])
+
+    def test_endpoint_memory_cache(self):
+        self.redirect_probe()
+        with patch('sumologic.DEFAULT_ENDPOINT', self.endpoint):
+            clients = [SumoLogic('accessId', 'accessKey') for _ in range(3)]
+            self.redirect_probe()
+            other = SumoLogic('otherAccessId', 'accessKey')
+        self.assertEqual(set(client.endpoint for client in clients), {self.endpoint.replace('/api', '/au/api')})
+        self.assertEqual(other.endpoint, self.endpoint.replace('/api', '/au/api'))
+        self.assertEqual(len(self.server.requests), 4, "The endpoint should be probed once per access id")
+
+    def test_endpoint_file_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        cache_file = os.path.join(tmpdir, 'endpoints.json')
+        self.redirect_probe()
+        with patch('sumologic.DEFAULT_ENDPOINT', self.endpoint):
+            SumoLogic('accessId', 'accessKey', endpoint_cache_file=cache_file)
+            sumologic._endpoint_cache.clear()
+            client = SumoLogic('accessId', 'accessKey', endpoint_cache_file=cache_file)
+        self.assertEqual(client.endpoint, self.endpoint.replace('/api', '/au/api'))
+        self.assertEqual(len(self.server.requests), 2)
+        with open(cache_file) as f:
+            self.assertNotIn('accessId', f.read())
+
+    def test_endpoint_cache_ttl(self):
+        self.redirect_probe()
+        with patch('sumologic.DEFAULT_ENDPOINT', self.endpoint):
+            SumoLogic('accessId', 'accessKey', endpoint_cache_ttl=60)
+            SumoLogic('accessId', 'accessKey', endpoint_cache_ttl=60)
+            self.redirect_probe()
+            with patch('sumologic.time.time', return_value=time.time() + 61):
+                SumoLogic('accessId', 'accessKey', endpoint_cache_ttl=60)
+        self.assertEqual(len(self.server.requests), 4, "The endpoint should be probed again after the ttl")
+
+    def test_endpoint_not_cached_on_failure(self):
+        for status in (429, 503):
+            self.server.responses = [(status, {'Retry-After': '0'}, b'{}')] * 2
+            with patch('sumologic.DEFAULT_ENDPOINT', self.endpoint):
+                SumoLogic('accessId', 'accessKey', max_retries=1, backoff_factor=0)
+                self.assertEqual(sumologic._endpoint_cache, {})
+                self.redirect_probe()
+                client = SumoLogic('accessId', 'accessKey')
+            self.assertEqual(client.endpoint, self.endpoint.replace('/api', '/au/api'))
+            sumologic._endpoint_cache.clear()
+        self.assertEqual(len(self.server.requests), 8)
+
+    def test_deployment_endpoint(self):
+        with patch('sumologic.DEFAULT_ENDPOINT', self.endpoint):
+            self.assertEqual(SumoLogic('accessId', 'accessKey', deployment='au').endpoint,
+                             'https://api.au.sumologic.com/api')
+            self.assertEqual(SumoLogic('accessId', 'accessKey', deployment='us1').endpoint, self.endpoint)
+            self.assertEqual(SumoLogic('accessId', 'accessKey', deployment='long').endpoint,
+                             'https://long-api.sumologic.net/api')
+        self.assertEqual(self.server.requests, [], "A deployment should not need a probe")
+
+    def get_cookies(self, *clients):
+        for client in clients:
+            client.get('/collectors')
+        return [cookie for _, _, cookie, _ in self.server.requests[-len(clients):]]
+
+    def test_shared_cookie_jar(self):
+        self.server.responses = [(200, {'Set-Cookie': 'AWSALB=abc; Path=/'}, b'{}')]
+        client = SumoLogic('accessId', 'accessKey', self.endpoint)
+        client.get('/collectors')
+        same_account = SumoLogic('accessId', 'accessKey', self.endpoint)
+        other_account = SumoLogic('otherAccessId', 'accessKey', self.endpoint)
+        self.assertIs(same_account.session.cookies, client.session.cookies)
+        self.assertEqual(self.get_cookies(client, same_account, other_account), ['AWSALB=abc', 'AWSALB=abc', None])
+
+    def test_cookie_file(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        cookie_file = os.path.join(tmpdir, 'cookies.txt')
+        self.server.responses = [(200, {'Set-Cookie': 'AWSALB=abc; Path=/'}, b'{}')]
+        client = SumoLogic('accessId', 'accessKey', self.endpoint, cookieFile=cookie_file)
+        client.get('/collectors')
+        self.assertFalse(os.path.exists(cookie_file), "Cookies should only be written by save_cookies")
+        client.save_cookies()
+        with open(cookie_file) as f:
+            self.assertTrue(f.read().startswith('#LWP-Cookies-2.0'))
+        sumologic._cookie_jars.clear()
+        client = SumoLogic('accessId', 'accessKey', self.endpoint, cookieFile=cookie_file)
+        self.assertEqual(self.get_cookies(client), ['AWSALB=abc'])
+
+    def test_invalid_cookie_file(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        cookie_file = os.path.join(tmpdir, 'cookies.txt')
+        with open(cookie_file, 'w') as f:
+            f.write('# Netscape HTTP Cookie File\n')
+        client = SumoLogic('accessId', 'accessKey', self.endpoint, cookieFile=cookie_file)
+        self.assertEqual(len(client.session.cookies), 0)
+        self.assertEqual(self.get_cookies(client), [None])
+        self.server.responses = [(200, {'Set-Cookie': 'AWSALB=abc; Path=/'}, b'{}')]
+        client.get('/collectors')
+        client.save_cookies()
+        with open(cookie_file) as f:
+            self.assertTrue(f.read().startswith('#LWP-Cookies-2.0'))
+
+
+if __name__ == '__main__':
+
+    unittest.main()